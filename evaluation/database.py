@@ -1,9 +1,16 @@
 import sqlite3
 import logging
+from collections import OrderedDict
+
+# largest number of keys resolved by one query in ProbTable.get_many, below sqlite's limit of 999 variables
+BATCH_SIZE = 300
 
 class ProbTable():
-    """Class representing one table in the prob-db"""
-    def __init__(self, cursor, tablename):
+    """
+    Class representing one table in the prob-db. The results of the last cache_size lookups are kept in an LRU
+    cache, and get_many resolves a batch of keys with one query.
+    """
+    def __init__(self, cursor, tablename, cache_size=1 << 17):
         self.cursor = cursor
         self.name = tablename
 
@@ -14,6 +21,8 @@ class ProbTable():
         self.total = self.fetch_total()
         self.sql = 'SELECT prob FROM ' + self.name + ' WHERE ' + \
                    ' AND '.join(c + '=?' for c in self.cols[1:])
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
     
     def get(self, params):
         """returns the count for the given params"""
@@ -21,17 +30,137 @@ class ProbTable():
         # Make sure you use the right database for the model
         assert(len(params) == len(self.cols) - 1)
 
+        params = tuple(params)
+        if params in self.cache:
+            self.cache.move_to_end(params)
+            return self.cache[params]
         self.cursor.execute(self.sql, params)
         res = self.cursor.fetchone()
         tot = self.total
-        return res[0]/tot if res else None
+        val = res[0]/tot if res else None
+        self.remember(params, val)
+        return val
+
+    def get_many(self, keys):
+        """returns the counts for a list of keys, as get, with one query for the keys that are not cached"""
+        keys = [tuple(key) for key in keys]
+        assert(all(len(key) == len(self.cols) - 1 for key in keys))
+        missing = list(OrderedDict.fromkeys(key for key in keys if key not in self.cache))
+        for i in range(0, len(missing), BATCH_SIZE):
+            batch = missing[i:i + BATCH_SIZE]
+            found = dict()
+            for row in self.fetch_many(batch):
+                found[tuple(row[1:])] = row[0]/self.total
+            for key in batch:
+                self.remember(key, found.get(key))
+        return [self.get(key) for key in keys]
+
+    def fetch_many(self, keys):
+        """returns the rows (prob followed by the key columns) of the keys in one query"""
+        cols = self.cols[1:]
+        values = ', '.join('(' + ', '.join('?' * len(cols)) + ')' for _ in keys)
+        sql = 'SELECT t.prob, ' + ', '.join('t.' + c for c in cols) + \
+              ' FROM (VALUES ' + values + ') AS k JOIN ' + self.name + ' AS t ON ' + \
+              ' AND '.join('t.%s=k.column%d' % (c, i + 1) for i, c in enumerate(cols))
+        self.cursor.execute(sql, [param for key in keys for param in key])
+        return self.cursor.fetchall()
+
+    def remember(self, params, val):
+        self.cache[params] = val
+        self.cache.move_to_end(params)
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
     
+    def rows(self):
+        """yields the rows of the table, the count followed by the key columns"""
+        cursor = self.cursor.connection.cursor()
+        cursor.execute('SELECT * FROM ' + self.name)
+        yield from cursor
+        cursor.close()
+
     def fetch_total(self):
         """returns the total count for the table"""
         self.cursor.execute("SELECT total FROM total_probs WHERE name=?",
                 (self.name,))
         return self.cursor.fetchone()[0]
 
+def table_columns(name, n_cols=None):
+    """
+    returns the key columns of a table, guessed from its name as utils/create_db.sh does. If the number of key
+    columns in the file (n_cols) is given and does not match the name, child, head and deprel are taken in order.
+    """
+    cols = ['child']
+    if 'uni' not in name and 'onlydep' not in name:
+        cols.append('head')
+    if 'nodep' not in name and 'onlydep' not in name:
+        cols.append('deprel')
+    if n_cols is not None and n_cols != len(cols):
+        cols = ['child', 'head', 'deprel'][:n_cols]
+    return cols
+
+def create_table(conn, name, cols, schema='main'):
+    """
+    (re)creates the table name, without index, in the schema ProbTable reads. The tables precompute.py computed
+    from a table name that is replaced are dropped, they would not match it anymore.
+    """
+    drop_derived(conn, name, schema)
+    conn.execute('DROP TABLE IF EXISTS %s.%s' % (schema, name))
+    conn.execute('CREATE TABLE %s.%s(prob NUM, %s)' % (schema, name, ', '.join(c + ' TEXT' for c in cols)))
+
+def insert_rows(conn, name, rows, cols):
+    """inserts rows (prob followed by the key columns) into the table name and returns the sum of the probs"""
+    total = 0.0
+    def counted():
+        nonlocal total
+        for row in rows:
+            prob = float(row[0])
+            total = total + prob
+            yield (prob,) + tuple(row[1:])
+    conn.executemany('INSERT INTO %s VALUES (%s)' % (name, ', '.join('?' * (len(cols) + 1))), counted())
+    return total
+
+def finish_table(conn, name, cols, total):
+    """creates the unique lookup index of the table name and sets its total in total_probs"""
+    conn.execute('CREATE UNIQUE INDEX lookup_%s ON %s(%s)' % (name, name, ', '.join(cols)))
+    conn.execute('CREATE TABLE IF NOT EXISTS total_probs(name TEXT UNIQUE, total NUM)')
+    conn.execute('DELETE FROM total_probs WHERE name=?', (name,))
+    conn.execute('INSERT INTO total_probs(name, total) VALUES (?, ?)', (name, total))
+
+def has_sources(conn, schema='main'):
+    """returns whether the schema has a precomputed_sources table"""
+    return conn.execute("SELECT name FROM %s.sqlite_master WHERE type='table' AND name='precomputed_sources'"
+                        % schema).fetchone() is not None
+
+def set_sources(conn, name, sources):
+    """records the totals of the tables, by name, that the table name was computed from, see precompute.py"""
+    conn.execute('CREATE TABLE IF NOT EXISTS precomputed_sources(name TEXT, source TEXT, total NUM)')
+    conn.execute('DELETE FROM precomputed_sources WHERE name=?', (name,))
+    conn.executemany('INSERT INTO precomputed_sources(name, source, total) VALUES (?, ?, ?)',
+                     [(name, source, total) for source, total in sources.items()])
+
+def drop_derived(conn, name, schema='main'):
+    """drops the tables computed from the table name (see set_sources), and the sources of name itself"""
+    if not has_sources(conn, schema):
+        return
+    conn.execute('DELETE FROM %s.precomputed_sources WHERE name=?' % schema, (name,))
+    derived = [row[0] for row in conn.execute('SELECT DISTINCT name FROM %s.precomputed_sources WHERE source=?'
+                                              % schema, (name,))]
+    for table in derived:
+        conn.execute('DROP TABLE IF EXISTS %s.%s' % (schema, table))
+        conn.execute('DELETE FROM %s.total_probs WHERE name=?' % schema, (table,))
+        conn.execute('DELETE FROM %s.precomputed_sources WHERE name=?' % schema, (table,))
+
+def load_table(conn, name, rows, cols=None, total=None):
+    """
+    (re)creates the table name from rows (prob followed by the key columns) in one transaction, the index is built
+    after the rows are inserted and the total is summed while inserting unless it is given
+    """
+    cols = cols or table_columns(name)
+    with conn:
+        create_table(conn, name, cols)
+        row_total = insert_rows(conn, name, rows, cols)
+        finish_table(conn, name, cols, row_total if total is None else total)
+
 class ProbDatabase():
     """Convinience class for opening and closing a database"""
     def __init__(self, filename):
@@ -41,6 +170,22 @@ class ProbDatabase():
         self.conn = sqlite3.connect(filename)
         self.cursor = self.conn.cursor()
 
+    def table(self, name):
+        return ProbTable(self.cursor, name)
+
+    def tables(self):
+        """returns the names of the probability tables"""
+        self.cursor.execute("SELECT name FROM sqlite_master WHERE type='table' "
+                            "AND name NOT IN ('total_probs', 'precomputed_sources')")
+        return [row[0] for row in self.cursor.fetchall()]
+
+    def sources(self, name):
+        """returns the totals of the tables the table name was computed from by name, see set_sources"""
+        if not has_sources(self.conn):
+            return dict()
+        self.cursor.execute('SELECT source, total FROM precomputed_sources WHERE name=?', (name,))
+        return dict(self.cursor.fetchall())
+
     def close(self):
         if self.conn:
             self.conn.commit()
@@ -0,0 +1,138 @@
+import numpy as np
+
+
+def align(scope, array, union, sizes):
+    """returns array, with one axis per variable in scope, transposed and reshaped to broadcast over union"""
+    order = sorted(range(len(scope)), key=lambda axis: union.index(scope[axis]))
+    shape = [sizes[v] if v in scope else 1 for v in union]
+    return np.transpose(array, order).reshape(shape)
+
+
+def eliminate(sizes, factors):
+    """
+    Minimizes a sum of factors by variable elimination. A factor is a (scope, array) pair, scope a tuple of distinct
+    variables (indices into sizes, the number of values of each variable) and array the cost of every combination of
+    their values, with one axis per variable. The variable with the smallest table is eliminated first, so a tree is
+    solved in time linear in its size.
+    :return: the minimal cost and a value for each variable reaching it
+    """
+    factors = dict(enumerate((tuple(scope), np.asarray(array, dtype=np.float64)) for scope, array in factors))
+    # the factors of each variable
+    index = dict()
+    for i, (scope, _) in factors.items():
+        for v in scope:
+            index.setdefault(v, set()).add(i)
+    next_id = len(factors)
+    constant = 0.0
+    eliminated = list()
+
+    def table_size(v):
+        return np.prod([sizes[u] for u in set(u for i in index[v] for u in factors[i][0])])
+
+    while index:
+        v = min(index, key=table_size)
+        touching = [factors.pop(i) for i in index.pop(v)]
+        union = sorted(set(u for scope, _ in touching for u in scope))
+        total = np.zeros([sizes[u] for u in union])
+        for scope, array in touching:
+            total = total + align(scope, array, union, sizes)
+        axis = union.index(v)
+        rest = tuple(u for u in union if u != v)
+        eliminated.append((v, rest, np.argmin(total, axis=axis)))
+        message = np.min(total, axis=axis)
+        if rest:
+            factors[next_id] = (rest, message)
+            for u in rest:
+                index[u] = set(j for j in index[u] if j in factors)
+                index[u].add(next_id)
+            next_id = next_id + 1
+        else:
+            constant = constant + float(message)
+    constant = constant + sum(float(array) for _, array in factors.values())
+    values = [0] * len(sizes)
+    for v, rest, argmin in reversed(eliminated):
+        values[v] = int(argmin[tuple(values[u] for u in rest)])
+    return constant, values
+
+
+def best_mean(sizes, edges):
+    """
+    Finds the values of the variables minimizing the mean cost of the edges that have an estimate, or 0 if none has
+    one, as Evaluation.rank scores a candidate. An edge is a (scope, cost, found) triple of a factor scope, the cost
+    of each combination of values and 1 where the combination has an estimate (and cost 0 where it has not). The
+    mean is not a sum over the edges, so it is minimized by Dinkelbach's method: the sum of cost - l * found is
+    minimized by variable elimination with l the best mean so far, until that does not give a better mean.
+    :return: the values and their mean cost
+    """
+    def score(values):
+        cost = 0.0
+        count = 0
+        for scope, edge_cost, found in edges:
+            index = tuple(values[v] for v in scope)
+            cost = cost + edge_cost[index]
+            count = count + found[index]
+        return cost, count
+
+    costs = [edge_cost[found > 0] for _, edge_cost, found in edges if (found > 0).any()]
+    best = None
+    best_mean = None
+    if costs:
+        l = max(float(c.max()) for c in costs) + 1
+        while True:
+            _, values = eliminate(sizes, [(scope, edge_cost - l * found) for scope, edge_cost, found in edges])
+            cost, count = score(values)
+            if not count or (best is not None and cost/count >= best_mean - 1e-12 * abs(best_mean)):
+                break
+            best, best_mean = values, cost/count
+            l = best_mean
+    if best is None or best_mean > 0:
+        # a candidate without any estimate has mean 0
+        count, values = eliminate(sizes, [(scope, found) for scope, _, found in edges])
+        if count == 0:
+            return values, 0.0
+    return best, best_mean
+
+
+def beam_search(sizes, edges, width=100, k=1, order=None):
+    """
+    Finds up to k assignments of values to the variables with low mean edge cost, as in best_mean, by a beam search:
+    the variables are assigned in order, and after each one only the width partial assignments with the lowest mean
+    cost of the edges they complete are kept. The search is exact if width is at least the number of assignments.
+    :param order: the order in which the variables are assigned, e.g. from the root of the tree down
+    :return: (values, mean cost) pairs, best first
+    """
+    order = list(order) if order is not None else list(range(len(sizes)))
+    position = dict((v, j) for j, v in enumerate(order))
+    # the edges completed by the assignment of each variable, and the cost of those without variables
+    completed = [list() for _ in order]
+    base_cost = 0.0
+    base_count = 0
+    for scope, cost, found in edges:
+        if scope:
+            completed[max(position[v] for v in scope)].append((scope, cost, found))
+        else:
+            base_cost = base_cost + float(cost)
+            base_count = base_count + float(found)
+
+    def mean(state):
+        _, cost, count = state
+        return cost/count if count else 0.0
+
+    beam = [((), base_cost, base_count)]
+    for j, v in enumerate(order):
+        candidates = list()
+        for values, cost, count in beam:
+            for value in range(sizes[v]):
+                new = values + (value,)
+                new_cost = cost
+                new_count = count
+                for scope, edge_cost, found in completed[j]:
+                    index = tuple(new[position[u]] for u in scope)
+                    new_cost = new_cost + edge_cost[index]
+                    new_count = new_count + found[index]
+                candidates.append((new, new_cost, new_count))
+        # stable, so equally scored assignments keep the first possibilities first
+        candidates.sort(key=mean)
+        beam = candidates[:width]
+    return [([values[position[v]] for v in range(len(sizes))], mean((values, cost, count)))
+            for values, cost, count in beam[:k]]
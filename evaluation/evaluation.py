@@ -12,6 +12,8 @@ from nltk.corpus import wordnet as wn
 from argparse import ArgumentParser
 from os.path import basename, splitext
 import models
+import numpy as np
+from decoder import best_mean, beam_search
 from tqdm import tqdm
 
 
@@ -67,29 +69,148 @@ class Evaluation():
             for i, node in enumerate(tree)]
 
     def rank(self, adts, tree):
-        """take a ADT iterator and returns the top"""
+        """
+        take a ADT iterator and returns the top. The score of each bigram is kept, so for each ADT only the bigrams
+        of the nodes whose functions changed since the previous one (one word for consecutive products) are looked
+        up, and the score is updated by their difference. The score is recomputed in full only for an ADT that may
+        beat the best, so the result is the same as scoring every ADT from scratch.
+        """
         best = None
+        pos = self.to_pos(tree)
+        n = len(tree)
+        # the nodes whose bigram has node i as head, and the nodes whose function can change
+        dependents = [list() for _ in tree]
+        for i, node in enumerate(tree):
+            dependents[node.head % n].append(i)
+        ambiguous = [i for i, node in enumerate(tree) if node and self.possdict[(node.lemma, node.upostag)]]
+        # -log probability of each bigram, None if there is none, by dependent and head function
+        scores = [dict() for _ in tree]
+        costs = [None] * n
+        previous = None
+        p_sum = 0
+        total = 0
         for abstract_funs in adts:
-            bigrams = self.to_bigrams(abstract_funs, tree)
-            pos = self.to_pos(tree)
-            p = 0
-            total = 0
-            for bs, pos in zip(bigrams, pos):
-                try:
-                    p += -log(self.model.get(bs, pos))
+            if previous is None:
+                changed = range(n)
+            else:
+                changed = set()
+                for i in ambiguous:
+                    if abstract_funs[i] != previous[i]:
+                        changed.add(i)
+                        changed.update(dependents[i])
+            previous = abstract_funs
+            keys = [(i, (abstract_funs[i], abstract_funs[tree[i].head])) for i in changed]
+            missing = [(i, key) for i, key in keys if key not in scores[i]]
+            if missing:
+                probs = self.model.get_many([key + (tree[i].deprel,) for i, key in missing],
+                                            [pos[i] for i, _ in missing])
+                for (i, key), prob in zip(missing, probs):
+                    # No probability found for this bigram if prob is None or 0
+                    scores[i][key] = -log(prob) if prob else None
+            for i, key in keys:
+                cost = scores[i][key]
+                if costs[i] is not None:
+                    p_sum -= costs[i]
+                    total -= 1
+                if cost is not None:
+                    p_sum += cost
                     total += 1
-                except ValueError:
-                # No probability found for this bigram
-                    continue
-            p = p/total if total else p
+                costs[i] = cost
+            p = p_sum/total if total else 0
+            if best is not None and p > p_best + 1e-9 * max(1, abs(p_best)):
+                continue
+            # the same sum as scoring the ADT from scratch, which also removes the rounding of the updates
+            p_sum = 0
+            for cost in costs:
+                if cost is not None:
+                    p_sum += cost
+            p = p_sum/total if total else p_sum
             if not best or p < p_best:
                 p_best = p
                 best = abstract_funs
 
         return best
 
-    def annotate(self, tree, max_perm=10000, skip_long=False, progress_bar=False):
-        """take a UD tree and return the top ADT"""
+    def edges(self, tree):
+        """
+        returns the variables (the words with possibilities, as in abstract_funs_gen) of a UD tree, with their
+        possibilities, and one edge per node, its bigram with its head, as a (scope, cost, found) triple for
+        decoder.best_mean: the -log probability of each combination of the possibilities of the two words, as scored
+        by rank, and whether the model has one
+        """
+        variables = dict()
+        for node in tree:
+            if node and self.possdict[(node.lemma, node.upostag)]:
+                variables.setdefault((node.lemma, node.upostag), len(variables))
+        domains = [self.possdict[w] for w in variables]
+        pos = self.to_pos(tree)
+        edges = list()
+        for i, node in enumerate(tree):
+            if not node:
+                continue
+            head = tree[node.head]
+            ends = [variables.get((n.lemma, n.upostag)) if n else None for n in (node, head)]
+            scope = tuple(v for v in dict.fromkeys(ends) if v is not None)
+            # the values of the scope, and of the dependent and head for each of them
+            combinations = list(product(*[domains[v] for v in scope]))
+            pairs = [tuple(values[scope.index(v)] if v is not None else None for v in ends)
+                     for values in combinations]
+            probs = self.model.get_many([(dep, hd, node.deprel) for dep, hd in pairs], [pos[i]] * len(pairs))
+            shape = [len(domains[v]) for v in scope]
+            cost = np.array([-log(p) if p else 0.0 for p in probs]).reshape(shape)
+            found = np.array([1.0 if p else 0.0 for p in probs]).reshape(shape)
+            edges.append((scope, cost, found))
+        return list(variables.keys()), domains, edges
+
+    def decode(self, tree):
+        """
+        take a UD tree and return the ADT that rank would give the lowest score of all combinations, found by
+        variable elimination over the bigrams of the tree instead of enumerating them, in time linear in the tree
+        size times the squared number of possibilities for a tree with distinct words. Among equally scored ADTs
+        the first possibility of each word is preferred.
+        """
+        words, domains, edges = self.edges(tree)
+        values, _ = best_mean([len(domain) for domain in domains], edges)
+        swap = defaultdict(lambda: None,
+                           ((w, domain[value]) for w, domain, value in zip(words, domains, values)))
+        return [swap[(node.lemma, node.upostag)] if node else None for node in tree]
+
+    def kbest(self, tree, k=10, beam=100):
+        """
+        take a UD tree and return up to k ADTs with their scores as in rank (lower is better), best first, found by a
+        beam search of the given width over the words from the root down, see decoder.beam_search
+        """
+        words, domains, edges = self.edges(tree)
+        # the depth of each node, following the heads to the root (head -1) and stopping at cycles
+        depths = list()
+        for node in tree:
+            depth = 0
+            while node and node.head >= 0 and depth < len(tree):
+                node = tree[node.head]
+                depth += 1
+            depths.append(depth)
+        first = dict()
+        for i, node in enumerate(tree):
+            if node and (node.lemma, node.upostag) in words:
+                key = (depths[i], i)
+                first[(node.lemma, node.upostag)] = min(first.get((node.lemma, node.upostag), key), key)
+        order = sorted(range(len(words)), key=lambda v: first[words[v]])
+        out = list()
+        for values, score in beam_search([len(domain) for domain in domains], edges, beam, k, order):
+            swap = defaultdict(lambda: None,
+                               ((w, domain[value]) for w, domain, value in zip(words, domains, values)))
+            out.append((score, [swap[(node.lemma, node.upostag)] if node else None for node in tree]))
+        return out
+
+    def annotate(self, tree, max_perm=10000, skip_long=False, progress_bar=False, exact=True, beam=None):
+        """
+        take a UD tree and return the top ADT, by decode, by kbest with a beam of width beam if it is given, or if
+        exact is False by ranking up to max_perm combinations of the possibilities of the words
+        """
+        if beam:
+            return self.kbest(tree, 1, beam)[0][1]
+        if exact:
+            return self.decode(tree)
         best = None 
         p_best = None
         n_combs = self.abstract_funs_size(tree)
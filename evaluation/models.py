@@ -1,14 +1,96 @@
-from database import ProbDatabase, ProbTable
+from prob_store import open_store
 import sqlite3
+import logging
 from math import log
 from clust import Cluster
 
 
+# the head of the back-off rows in the tables written by precompute.py
+BACKOFF = ''
+# the POS tables the Interpolation models use for all model tables
+POS_SOURCES = ['nodep_zero', 'nodep_zero_uni']
+
+
+def precomputed_name(basename, model, weights):
+    """the name of the table precompute.py writes for basename and a model with weights, e.g. bigram_backoff_0p4"""
+    return '_'.join([basename, model] + [repr(float(w)).replace('.', 'p').replace('-', 'm') for w in weights])
+
+
+def precomputed_sources(basename):
+    """the tables precompute.py computes the tables of a model table from"""
+    return [basename, basename + '_headuni', basename + '_uni']
+
+
+def open_precomputed(db, name, sources):
+    """
+    returns the table name written by precompute.py from the tables sources, or None if there is none or if it does
+    not match them anymore, because one of them was reloaded with other counts since. The models then compute their
+    values from the sources.
+    """
+    if name not in db.tables():
+        return None
+    if db.sources(name) != dict((source, db.table(source).total) for source in sources):
+        logging.warning('%s does not match %s, run precompute.py again', name, ', '.join(sources))
+        return None
+    return db.table(name)
+
+
+def backoff_key(key):
+    """the key of the back-off row for key, with its head replaced by BACKOFF"""
+    return tuple(key[0:1]) + (BACKOFF,) + tuple(key[2:])
+
+
+def get_precomputed(table, key):
+    """
+    returns the value of key in a table written by precompute.py (or a dict of its rows), which is that of its
+    back-off row if key is not in the table, or None if neither is
+    """
+    val = table.get(key)
+    return val if val is not None else table.get(backoff_key(key))
+
+
+def get_many_precomputed(table, keys):
+    """get_precomputed for a list of keys, with one batch for the keys and one for the back-off rows of the rest"""
+    vals = table.get_many(keys)
+    missing = [i for i, val in enumerate(vals) if val is None]
+    for i, val in zip(missing, table.get_many([backoff_key(keys[i]) for i in missing])):
+        vals[i] = val
+    return vals
+
+
+def get_or_none(model, key, pos):
+    """returns model.get(key, pos), or None if the model has no estimate for key"""
+    try:
+        return model.get(key, pos)
+    except ValueError:
+        return None
+
+
+class Conditional():
+    """
+    The probability of the first column of a key given the rest, joint.get(key)/marg.get(key[1:]), or None if the
+    joint is 0 or missing
+    """
+    def __init__(self, joint, marg):
+        self.joint = joint
+        self.marg = marg
+
+    def get(self, key):
+        val = self.joint.get(key)
+        marg = self.marg.get(key[1:])
+        return val/marg if val and marg != 0 else None
+
+    def get_many(self, keys):
+        self.joint.get_many(keys)
+        self.marg.get_many([key[1:] for key in keys])
+        return [self.get(key) for key in keys]
+
+
 class Unigram():
     def __init__(self, dbfile, basename):
-        self.db = ProbDatabase(dbfile)
+        self.db = open_store(dbfile)
         self.basename = basename
-        self.table = ProbTable(self.db.cursor, self.basename)
+        self.table = self.db.table(self.basename)
 
     def log(self, key, pos=None):
         val = self.get(key)
@@ -22,17 +104,31 @@ class Unigram():
         val = self.table.get(key)
         return val if val else 0
 
+    def get_many(self, keys, pos_keys=None):
+        """get for a list of keys, with one query per table"""
+        keys = [(key,) if isinstance(key, str) else key for key in keys]
+        self.table.get_many([key[0:1] for key in keys])
+        return [self.get(key) for key in keys]
+
 
 class Bigram():
+    # the number of columns of the keys
+    key_size = 2
+
     def __init__(self, dbfile, basename, backoff=0.4):
-        self.db = ProbDatabase(dbfile)
+        self.db = open_store(dbfile)
         self.basename = basename
         self.backoff = backoff
-        self.bigram_table = ProbTable(self.db.cursor, self.basename)
-        self.unigram_table = ProbTable(self.db.cursor, self.basename + '_uni')
+        self.bigram_table = self.db.table(self.basename)
+        self.unigram_table = self.db.table(self.basename + '_uni')
 
         # marginal distributions
-        self.marg_table = ProbTable(self.db.cursor, self.basename + '_headuni')
+        self.marg_table = self.db.table(self.basename + '_headuni')
+        self.conditional = Conditional(self.bigram_table, self.marg_table)
+
+        # the result of get for each seen bigram and back-off row, if precompute.py has written it for backoff
+        self.precomputed = open_precomputed(self.db, precomputed_name(self.basename, 'backoff', [backoff]),
+                                            precomputed_sources(self.basename))
 
     def check(self):
         assert(len(self.bigram_table.cols) == 3)
@@ -42,15 +138,35 @@ class Bigram():
     def log(self, key, pos=None):
         return -log(self.get(key))
 
+    def get_many(self, keys, pos_keys):
+        """get for lists of keys and pos keys, None where get raises, with one query per table for the batch"""
+        if self.precomputed:
+            return get_many_precomputed(self.precomputed, [key[0:self.key_size] for key in keys])
+        self.prefetch(keys, pos_keys)
+        return [get_or_none(self, key, pos) for key, pos in zip(keys, pos_keys)]
+
+    def prefetch(self, keys, pos_keys):
+        """looks up the rows that get uses for the keys in one query per table, they are then cached"""
+        keys = [key[0:2] for key in keys]
+        self.conditional.get_many(keys)
+        self.unigram_table.get_many([key[0:1] for key in keys])
+
     def get(self, key, pos=None):
         # bigram
         key = key[0:2]
-        val = self.bigram_table.get(key)
-        marg = self.marg_table.get(key[1:])
-        if not val or marg == 0:
+        if self.precomputed:
+            return self.get_precomputed(key)
+        val = self.conditional.get(key)
+        if not val:
             return self.backoff*self.unigram(key[0:1])
         else:
-            return val/marg
+            return val
+
+    def get_precomputed(self, key):
+        val = get_precomputed(self.precomputed, key)
+        if val is None:
+            raise ValueError('No estimated prob for %s' % str(key))
+        return val
     
     def unigram(self, key):
         val = self.unigram_table.get(key)
@@ -59,32 +175,39 @@ class Bigram():
         return val
 
 class BigramDeprel(Bigram):
+    key_size = 3
+
+    def prefetch(self, keys, pos_keys):
+        keys = [key[0:3] for key in keys]
+        self.conditional.get_many(keys)
+        self.unigram_table.get_many([key[0:1]+key[2:] for key in keys])
 
     def get(self, key, pos=None):
         # bigram with deprel
         key = key[0:3]
-        val = self.bigram_table.get(key)
-        marg = self.marg_table.get(key[1:])
-        if not val or marg == 0:
+        if self.precomputed:
+            return self.get_precomputed(key)
+        val = self.conditional.get(key)
+        if not val:
             return self.backoff*Bigram.unigram(self, key[0:1]+key[2:])
         else:
-            return val/marg
+            return val
 
 class ClustBigram(Bigram):
 
     def __init__(self, dbfile, basename, wnname, depclustname, headclustname):
-        self.db = ProbDatabase(dbfile)
+        self.db = open_store(dbfile)
         self.basename = basename
         self.backoff = backoff
-        self.bigram_table = ProbTable(self.db.cursor, self.basename)
-        self.unigram_table = ProbTable(self.db.cursor, self.basename + '_uni')
-        self.wn_uni_tables = ProbTable(self.db.cursor, self.wnname + '_uni')
+        self.bigram_table = self.db.table(self.basename)
+        self.unigram_table = self.db.table(self.basename + '_uni')
+        self.wn_uni_tables = self.db.table(self.wnname + '_uni')
 
         self.depclust= Cluster(depclustname)
         self.headclust= Cluster(headclustname)
 
         # marginal distributions
-        self.marg_table = ProbTable(self.db.cursor, self.basename + '_headuni')
+        self.marg_table = self.db.table(self.basename + '_headuni')
 
     def get(self, key, pos=None):
         # bigram
@@ -101,41 +224,80 @@ class ClustBigram(Bigram):
 
 
 class Interpolation():
+    key_size = 2
+
     def __init__(self, dbfile, basename, constant=[0.4, 0.2, 0.2, 0.2]):
-        self.db = ProbDatabase(dbfile)
+        self.db = open_store(dbfile)
         self.basename = basename
 
-        self.bigram      = ProbTable(self.db.cursor, self.basename)
-        self.unigram     = ProbTable(self.db.cursor, self.basename + '_uni')
-        self.marg_head   = ProbTable(self.db.cursor, self.basename + '_headuni')
-        self.marg_deprel = ProbTable(self.db.cursor, 'onlydep_zero')
-        self.bigramcat   = ProbTable(self.db.cursor, 'nodep_zero')
-        self.unigramcat  = ProbTable(self.db.cursor, 'nodep_zero_uni')
+        self.bigram      = self.db.table(self.basename)
+        self.unigram     = self.db.table(self.basename + '_uni')
+        self.marg_head   = self.db.table(self.basename + '_headuni')
+        self.marg_deprel = self.db.table('onlydep_zero')
+        self.bigramcat   = self.db.table('nodep_zero')
+        self.unigramcat  = self.db.table('nodep_zero_uni')
+
+        # the bigrams given the head
+        self.bigram_cond    = Conditional(self.bigram, self.marg_head)
+        self.bigramcat_cond = Conditional(self.bigramcat, self.unigramcat)
 
         self.delta = constant
 
+        # the bigram and unigram terms of each seen bigram and back-off row, and the same for the POS terms, if
+        # precompute.py has written them for these constants. The POS table is small and kept in memory.
+        self.precomputed = open_precomputed(self.db, precomputed_name(self.basename, 'interpolation', constant[0:2]),
+                                            precomputed_sources(self.basename))
+        pos_table = open_precomputed(self.db, precomputed_name('nodep_zero', 'interpolation', constant[2:4]),
+                                     POS_SOURCES)
+        self.precomputed_pos = None
+        if self.precomputed and pos_table:
+            self.precomputed_pos = dict((tuple(row[1:]), row[0]/pos_table.total) for row in pos_table.rows())
+
     def log(self, bigram_key, pos_key):
         return self.get(bigram_key, pos_key)
+
+    def get_many(self, bigram_keys, pos_keys):
+        """get for lists of keys and pos keys, with one query per table for the batch"""
+        if self.precomputed_pos is not None:
+            vals = get_many_precomputed(self.precomputed, [key[0:self.key_size] for key in bigram_keys])
+            return [self.add_pos(val, pos_key) for val, pos_key in zip(vals, pos_keys)]
+        self.prefetch(bigram_keys, pos_keys)
+        return [self.get(bigram_key, pos_key) for bigram_key, pos_key in zip(bigram_keys, pos_keys)]
+
+    def prefetch(self, bigram_keys, pos_keys):
+        """looks up the rows that get uses for the keys in one query per table, they are then cached"""
+        bigram_keys = [key[0:2] for key in bigram_keys]
+        pos_keys = [key[0:2] for key in pos_keys]
+        self.bigram_cond.get_many(bigram_keys)
+        self.unigram.get_many([key[0:1] for key in bigram_keys])
+        self.bigramcat_cond.get_many(pos_keys)
+        self.unigramcat.get_many([key[0:1] for key in pos_keys])
     
+    def add_pos(self, val, pos_key):
+        """returns the precomputed bigram terms val (None if there are none) plus the POS terms for pos_key"""
+        pos_val = get_precomputed(self.precomputed_pos, tuple(pos_key[0:2]))
+        return (val or 0) + (pos_val or 0)
+
     def get(self, bigram_key, pos_key):
         total = 0
         
         bigram_key = bigram_key[0:2]
         pos_key = pos_key[0:2]
 
+        if self.precomputed_pos is not None:
+            return self.add_pos(get_precomputed(self.precomputed, bigram_key), pos_key)
+
         # bigram
-        val = self.bigram.get(bigram_key)
-        marg = self.marg_head.get(bigram_key[-1:])
-        total = total + self.delta[0] * val/marg if val else total
+        val = self.bigram_cond.get(bigram_key)
+        total = total + self.delta[0] * val if val else total
 
         # unigram
         val = self.unigram.get(bigram_key[0:1])
         total = total + self.delta[1] * val if val else total
 
         # bigram categories
-        val = self.bigramcat.get(pos_key)
-        marg = self.unigramcat.get(pos_key[-1:])
-        total = total + self.delta[2] * val/marg if val else total
+        val = self.bigramcat_cond.get(pos_key)
+        total = total + self.delta[2] * val if val else total
 
         # unigram categories
         val = self.unigramcat.get(pos_key[0:1])
@@ -144,6 +306,15 @@ class Interpolation():
         return total
     
 class InterpolationDeprel(Interpolation):
+    key_size = 3
+
+    def prefetch(self, bigram_keys, pos_keys):
+        bigram_keys = [key[0:3] for key in bigram_keys]
+        pos_keys = [key[0:3] for key in pos_keys]
+        self.bigram_cond.get_many(bigram_keys)
+        self.unigram.get_many([key[0:1]+key[2:] for key in bigram_keys])
+        self.bigramcat_cond.get_many([key[0:2] for key in pos_keys])
+        self.unigramcat.get_many([key[0:1] for key in pos_keys])
 
     def get(self, bigram_key, pos_key):
         total = 0
@@ -151,19 +322,20 @@ class InterpolationDeprel(Interpolation):
         bigram_key = bigram_key[0:3]
         pos_key = pos_key[0:3]
 
+        if self.precomputed_pos is not None:
+            return self.add_pos(get_precomputed(self.precomputed, bigram_key), pos_key)
+
         # bigram
-        val = self.bigram.get(bigram_key)
-        marg = self.marg_head.get(bigram_key[1:])
-        total = total + self.delta[0] * val/marg if val else total
+        val = self.bigram_cond.get(bigram_key)
+        total = total + self.delta[0] * val if val else total
 
         # unigram
         val = self.unigram.get(bigram_key[0:1]+bigram_key[2:])
         total = total + self.delta[1] * val if val else total
 
         # bigram categories
-        val = self.bigramcat.get(pos_key[0:2])
-        marg = self.unigramcat.get(pos_key[1:2])
-        total = total + self.delta[2] * val/marg if val else total
+        val = self.bigramcat_cond.get(pos_key[0:2])
+        total = total + self.delta[2] * val if val else total
 
         # unigram categories
         val = self.unigramcat.get(pos_key[0:1])
@@ -0,0 +1,109 @@
+import argparse
+import os
+from prob_store import open_store, add_tables
+from models import BACKOFF, POS_SOURCES, precomputed_name, precomputed_sources
+
+
+def table_values(table):
+    """returns the values of the rows of table by key, as table.get returns them"""
+    return dict((tuple(row[1:]), row[0]/table.total) for row in table.rows())
+
+
+def conditional_rows(joint, marg):
+    """
+    yields the rows of the conditional table of joint given marg, the marginal of its key without the first column,
+    with the value joint.get(key)/marg.get(key[1:]) that models.Conditional computes. Keys with a zero count or
+    without marginal are left out, the models back off for them.
+    """
+    margs = table_values(marg)
+    for row in joint.rows():
+        val = row[0]/joint.total
+        m = margs.get(tuple(row[2:]))
+        if val and m:
+            yield (val/m,) + tuple(row[1:])
+
+
+def unigram_key(key):
+    """the key of the unigram of a bigram key, without its head"""
+    return key[0:1] + key[2:]
+
+
+def backoff_rows(unigram, weight):
+    """yields the back-off rows for the unigrams, weight times their value keyed by models.backoff_key"""
+    for key, val in unigram.items():
+        if val:
+            yield (weight*val,) + key[0:1] + (BACKOFF,) + key[1:]
+
+
+def backoff_model_rows(joint, marg, unigram, backoff):
+    """
+    yields the rows of the table of models.Bigram (or BigramDeprel) with back-off weight backoff: the conditional of
+    each seen bigram, and backoff times the unigram of the dependent in the back-off rows
+    """
+    yield from conditional_rows(joint, marg)
+    yield from backoff_rows(table_values(unigram), backoff)
+
+
+def interpolation_rows(joint, marg, unigram, weights):
+    """
+    yields the rows of the table of two terms of models.Interpolation, a conditional and a unigram weighted by
+    weights: their sum for each seen bigram, and the unigram term alone in the back-off rows
+    """
+    unigrams = table_values(unigram)
+    for row in conditional_rows(joint, marg):
+        total = 0
+        total = total + weights[0] * row[0]
+        val = unigrams.get(unigram_key(row[1:]))
+        total = total + weights[1] * val if val else total
+        yield (total,) + row[1:]
+    yield from backoff_rows(unigrams, weights[1])
+
+
+def precompute(path, basenames, backoff=0.4, constant=(0.4, 0.2, 0.2, 0.2)):
+    """
+    adds to the store at path, for each model table in basenames, the tables that models.Bigram (or BigramDeprel)
+    with the back-off weight backoff and models.Interpolation (or InterpolationDeprel) with constant read instead of
+    computing get from several tables: get is then one lookup for a seen bigram and two for one that backs off. The
+    tables are named after the weights (see models.precomputed_name) and have a total of 1 so that get returns the
+    values themselves. The Interpolation tables need the POS tables nodep_zero and nodep_zero_uni. The totals of the
+    tables each one is computed from are stored with it, so that the models do not use it once they are reloaded.
+    """
+    store = open_store(path)
+    names = store.tables()
+    pos_tables = all(name in names for name in POS_SOURCES)
+    tables = list()
+    sources = dict()
+    for basename in basenames:
+        joint, marg, unigram = [store.table(name) for name in precomputed_sources(basename)]
+        totals = dict((table.name, table.total) for table in [joint, marg, unigram])
+        name = precomputed_name(basename, 'backoff', [backoff])
+        tables.append((name, joint.cols[1:], list(backoff_model_rows(joint, marg, unigram, backoff)), 1.0))
+        sources[name] = totals
+        if pos_tables:
+            name = precomputed_name(basename, 'interpolation', constant[0:2])
+            tables.append((name, joint.cols[1:], list(interpolation_rows(joint, marg, unigram, constant[0:2])), 1.0))
+            sources[name] = totals
+    if pos_tables:
+        joint, unigram = [store.table(name) for name in POS_SOURCES]
+        name = precomputed_name('nodep_zero', 'interpolation', constant[2:4])
+        tables.append((name, joint.cols[1:], list(interpolation_rows(joint, unigram, unigram, constant[2:4])), 1.0))
+        sources[name] = dict((table.name, table.total) for table in [joint, unigram])
+    store.close()
+    add_tables(path, tables, sources)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="""
+    Precomputes the values of models.Bigram, BigramDeprel, Interpolation and InterpolationDeprel, with the given
+    weights, for every seen bigram of the model tables and for backing off from the unseen ones. The values are added
+    as tables named after the weights to the store, which the models then read instead of combining several tables.
+    """)
+    parser.add_argument('store', type=str, help='Database or array store directory')
+    parser.add_argument('tables', type=str, nargs='+', help='Model tables, e.g. bigram_deprel')
+    parser.add_argument('--backoff', type=float, default=0.4, help='Back-off weight of Bigram (default 0.4)')
+    parser.add_argument('--constant', type=float, nargs=4, default=[0.4, 0.2, 0.2, 0.2],
+                        help='Weights of Interpolation (default 0.4 0.2 0.2 0.2)')
+    args = parser.parse_args()
+    if not os.path.exists(args.store):
+        parser.error('{} does not exist'.format(args.store))
+    precompute(args.store, args.tables, args.backoff, args.constant)
@@ -0,0 +1,217 @@
+import argparse
+import sqlite3
+import json
+import os
+import numpy as np
+from database import ProbDatabase, load_table, set_sources
+
+
+class ArrayTable():
+    """
+    One table of an ArrayStore, with the same interface as database.ProbTable. The key columns are interned in the
+    string table of the store and each key is encoded as one integer, the ids in base radix, the codes are sorted and
+    a key is looked up by binary search in the memory mapped arrays.
+    """
+    def __init__(self, store, tablename):
+        self.store = store
+        self.name = tablename
+        if tablename not in store.meta:
+            raise Exception('Database with name %s doesn\'t exist' % self.name)
+        meta = store.meta[tablename]
+        self.cols = ['prob'] + meta['cols']
+        self.total = meta['total']
+        self.radix = meta['radix']
+        self.codes = np.load(store.path(tablename + '.codes.npy'), mmap_mode='r')
+        self.probs = np.load(store.path(tablename + '.probs.npy'), mmap_mode='r')
+
+    def code(self, params):
+        """returns the code of a key, or -1 if one of its columns is not in the table"""
+        code = 0
+        for param in params:
+            i = self.store.ids.get(param, self.radix)
+            if i >= self.radix:
+                return -1
+            code = code * self.radix + i
+        return code
+
+    def get(self, params):
+        """returns the count for the given params"""
+        assert(len(params) == len(self.cols) - 1)
+        code = self.code(params)
+        i = int(np.searchsorted(self.codes, code))
+        if code < 0 or i == len(self.codes) or self.codes[i] != code:
+            return None
+        return float(self.probs[i])/self.total
+
+    def get_many(self, keys):
+        """returns the counts for a list of keys, as get"""
+        if not len(self.codes):
+            return [None] * len(keys)
+        codes = np.array([self.code(key) for key in keys], dtype=np.int64)
+        i = np.minimum(np.searchsorted(self.codes, codes), len(self.codes) - 1)
+        found = (codes >= 0) & (self.codes[i] == codes)
+        return [float(p)/self.total if f else None for p, f in zip(self.probs[i].tolist(), found.tolist())]
+
+    def rows(self):
+        """yields the rows of the table, the count followed by the key columns"""
+        strings = self.store.strings
+        n_cols = len(self.cols) - 1
+        for code, prob in zip(self.codes.tolist(), self.probs.tolist()):
+            key = list()
+            for _ in range(n_cols):
+                code, i = divmod(code, self.radix)
+                key.append(strings[i])
+            yield (prob,) + tuple(reversed(key))
+
+
+class ArrayStore():
+    """
+    Probability tables in a directory, as written by write_array_store: the strings of all keys in strings.txt, the
+    columns, total and radix of each table in tables.json (and the totals of its sources if it was computed from
+    other tables), and its sorted key codes and counts in <table>.codes.npy and <table>.probs.npy
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        with open(self.path('tables.json'), mode='r', encoding='utf-8') as file:
+            self.meta = json.load(file)
+        with open(self.path('strings.txt'), mode='r', encoding='utf-8') as file:
+            self.strings = file.read().split('\n')[:-1]
+        self.ids = {string: i for i, string in enumerate(self.strings)}
+
+    def path(self, filename):
+        return os.path.join(self.directory, filename)
+
+    def table(self, name):
+        return ArrayTable(self, name)
+
+    def tables(self):
+        return list(self.meta.keys())
+
+    def sources(self, name):
+        """returns the totals of the tables the table name was computed from by name, as database.set_sources"""
+        return dict(self.meta[name].get('sources', dict()))
+
+    def close(self):
+        pass
+
+
+def is_array_store(path):
+    return os.path.isfile(os.path.join(path, 'tables.json'))
+
+
+def open_store(path):
+    """opens the probability tables at path, an ArrayStore directory or a SQLite database"""
+    if is_array_store(path):
+        return ArrayStore(path)
+    return ProbDatabase(path)
+
+
+def save_array(path, array):
+    """saves array to path through a temporary file, so that readers that have the old file mapped keep it"""
+    with open(path + '.tmp', mode='wb') as file:
+        np.save(file, array)
+    os.replace(path + '.tmp', path)
+
+
+def write_array_store(directory, tables, append=False, sources=None):
+    """
+    writes an ArrayStore to directory from tables, a list of (name, key columns, rows, total) where rows are
+    the count followed by the key columns and total is the sum of the counts if it is None. Rows with missing keys
+    (NULL in the database) are left out, they can not be looked up. sources maps the names of tables computed from
+    others to the totals of these, see database.set_sources. With append the tables are added to the store in
+    directory, replacing tables with the same names and dropping the tables computed from them, new strings are added
+    after the existing ones so the other tables stay valid.
+    """
+    sources = sources or dict()
+    os.makedirs(directory, exist_ok=True)
+    ids = dict()
+    meta = dict()
+    if append and is_array_store(directory):
+        store = ArrayStore(directory)
+        ids = store.ids
+        meta = store.meta
+    written = set()
+    for name, cols, rows, total in tables:
+        written.add(name)
+        for derived in [table for table in meta
+                        if table not in written and name in meta[table].get('sources', dict())]:
+            del meta[derived]
+            for suffix in ['.codes.npy', '.probs.npy']:
+                os.remove(os.path.join(directory, derived + suffix))
+        codes = [list() for _ in cols]
+        probs = list()
+        for row in rows:
+            if any(column is None for column in row[1:]):
+                continue
+            probs.append(float(row[0]))
+            for column, codes_of_column in zip(row[1:], codes):
+                codes_of_column.append(ids.setdefault(column, len(ids)))
+        radix = max(len(ids), 1)
+        if radix ** len(cols) >= 2 ** 63:
+            raise ValueError('Too many strings to encode the keys of %s' % name)
+        code = np.zeros(len(probs), dtype=np.int64)
+        for codes_of_column in codes:
+            code = code * radix + np.array(codes_of_column, dtype=np.int64)
+        probs = np.array(probs, dtype=np.float64)
+        order = np.argsort(code, kind='stable')
+        code = code[order]
+        if len(code) > 1 and (code[1:] == code[:-1]).any():
+            raise ValueError('Duplicate keys in %s' % name)
+        save_array(os.path.join(directory, name + '.codes.npy'), code)
+        save_array(os.path.join(directory, name + '.probs.npy'), probs[order])
+        meta[name] = dict(cols=list(cols), total=float(probs.sum()) if total is None else total, radix=radix)
+        if name in sources:
+            meta[name]['sources'] = sources[name]
+    with open(os.path.join(directory, 'strings.txt'), mode='w', encoding='utf-8') as file:
+        file.write(''.join(string + '\n' for string in ids))
+    # written last, so a directory is only taken as a store when it is complete
+    with open(os.path.join(directory, 'tables.json'), mode='w', encoding='utf-8') as file:
+        json.dump(meta, file)
+
+
+def add_tables(path, tables, sources=None):
+    """adds tables and their sources, as for write_array_store, to the store at path, an ArrayStore or a SQLite
+    database"""
+    sources = sources or dict()
+    if is_array_store(path):
+        write_array_store(path, tables, append=True, sources=sources)
+    else:
+        conn = sqlite3.connect(path)
+        for name, cols, rows, total in tables:
+            load_table(conn, name, rows, cols, total)
+        # after all tables are loaded, so that loading a source does not drop the tables computed from it
+        with conn:
+            for name in sources:
+                set_sources(conn, name, sources[name])
+        conn.close()
+
+
+def convert_store(src, dst, names=None):
+    """
+    converts the tables named in names (all if not given) of the store at src to a store at dst, an ArrayStore if
+    src is a SQLite database and the other way around
+    """
+    store = open_store(src)
+    names = names or store.tables()
+    tables = [store.table(name) for name in names]
+    sources = dict((name, store.sources(name)) for name in names if store.sources(name))
+    tables = [(table.name, table.cols[1:], table.rows(), table.total) for table in tables]
+    if is_array_store(src):
+        add_tables(dst, tables, sources)
+    else:
+        write_array_store(dst, tables, sources=sources)
+    store.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="""
+    Converts probability tables between a SQLite database (see utils/create_db.py) and an array store directory,
+    which is memory mapped and looked up by binary search. The models in models.py open either one.
+    """)
+    parser.add_argument('src', type=str, help='Database or array store directory')
+    parser.add_argument('dst', type=str, help='Array store directory if src is a database, otherwise a database')
+    parser.add_argument('-t', type=str, action='append', help='Table to convert, all if not given')
+    args = parser.parse_args()
+    if not os.path.exists(args.src):
+        parser.error('{} does not exist'.format(args.src))
+    convert_store(args.src, args.dst, args.t)
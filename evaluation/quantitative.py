@@ -1,8 +1,12 @@
 from trainomatic import trainomatic
 from collections import defaultdict
 from itertools import product, groupby, islice
-from utils import read_probs, Word
+from functools import reduce
+from operator import mul
+from utils import read_probs, Word, load_poss_dict, word_key
 from numpy import log
+import numpy as np
+from decoder import beam_search
 import logging 
 import sys
 import random
@@ -12,23 +16,12 @@ from os.path import basename, splitext
 import models
 
 def read_poss_dict(path):
-    with open(path, encoding='utf-8') as f:
-        # format: 
-        #    columnist \t NOUN \t columnistFem_N \t columnistMasc_N
-        lines = (l.strip().split('\t') for l in f)
-        return defaultdict(lambda: [], {Word(l[0].lower(), l[1].lower()): l[2:] for l in lines})
+    # format:
+    #    columnist \t NOUN \t columnistFem_N \t columnistMasc_N
+    return load_poss_dict(path, make_key=word_key)
 
 def reverse_poss_dict(poss_dict_path):
-    out = dict()
-    with open(poss_dict_path, encoding='utf-8') as f:
-        lines = (l.strip().split('\t') for l in f)
-        for c in lines:
-            for fun in c[2:]:
-                if fun in out:
-                    out[fun].append(Word(c[0].lower(), c[1].lower()))
-                else:
-                    out[fun] = [Word(c[0].lower(), c[1].lower())]
-    return out
+    return read_poss_dict(poss_dict_path).reverse()
 
 def get_bigrams_for_lemmas(lemmas, tree):
     bigrams = [w for w in get_bigrams(tree) 
@@ -61,17 +54,60 @@ def possible_bigrams(bigrams, possdict, deprel, max_perms=1000):
             yield [(swap(w), swap(h), rel) for w, h, rel in bigrams]
 
 
+def bigram_vocab(bigrams, possdict):
+    """the words of bigrams with possibilities, as in possible_bigrams"""
+    return list(dict.fromkeys(w for b in bigrams for w in b[:2] if not w.is_root and possdict[w]))
+
+
+def swap_bigrams(bigrams, swapdict, deprel):
+    """the bigrams with each word in swapdict replaced by its abstract function, as yielded by possible_bigrams"""
+    swap = lambda w: swapdict[w] if w in swapdict else w.lemma
+    if not deprel:
+        return [(swap(w), swap(h)) for w, h, rel in bigrams]
+    return [(swap(w), swap(h), rel) for w, h, rel in bigrams]
+
+
+def kbest_bigrams(bigrams, possdict, deprel, probs, k=10, beam=100):
+    """
+    returns up to k of the combinations of possibilities of possible_bigrams with the lowest bigrams_prob, best
+    first, as (score, bigrams) pairs, found by a beam search of the given width (see decoder.beam_search) instead of
+    enumerating them. The words are assigned in order of their number of bigrams, the lemma's word first.
+    """
+    vocab = bigram_vocab(bigrams, possdict)
+    variables = dict((w, v) for v, w in enumerate(vocab))
+    domains = [possdict[w] for w in vocab]
+    edges = list()
+    for dep, head, rel in bigrams:
+        ends = [variables.get(dep), variables.get(head)]
+        scope = tuple(v for v in dict.fromkeys(ends) if v is not None)
+        pairs = [tuple(values[scope.index(v)] if v is not None else w.lemma for v, w in zip(ends, (dep, head)))
+                 for values in product(*[domains[v] for v in scope])]
+        keys = [pair + (rel,) for pair in pairs] if deprel else pairs
+        ps = probs.get_many(keys, [(dep.upostag, head.upostag)] * len(keys))
+        shape = [len(domains[v]) for v in scope]
+        cost = np.array([-log(p) if p else 0.0 for p in ps]).reshape(shape)
+        found = np.array([1.0 if p else 0.0 for p in ps]).reshape(shape)
+        edges.append((scope, cost, found))
+    degree = [sum(v in scope for scope, _, _ in edges) for v in range(len(vocab))]
+    order = sorted(range(len(vocab)), key=lambda v: -degree[v])
+    return [(score, swap_bigrams(bigrams, dict(zip(vocab, (d[x] for d, x in zip(domains, values)))), deprel))
+            for values, score in beam_search([len(d) for d in domains], edges, beam, k, order)]
+
+
+def random_bigrams(bigrams, possdict, deprel):
+    """a combination of possibilities of possible_bigrams drawn uniformly"""
+    return swap_bigrams(bigrams, dict((w, random.choice(possdict[w])) for w in bigram_vocab(bigrams, possdict)),
+                        deprel)
+
+
 def bigrams_prob(bigrams, pos, probs):
     prob = 0
     total = 0
-    for bigram in bigrams:
-        try:
-            p = probs.get(bigram, pos)
-            if not p == 0:
-                prob += -log(p)
-                total += 1
-        except ValueError:
-            continue
+    for p in probs.get_many(bigrams, [pos] * len(bigrams)):
+        # None if no probability was found for the bigram
+        if p:
+            prob += -log(p)
+            total += 1
     if total == 0: 
         return 0
     else:
@@ -95,7 +131,12 @@ def read_wnid2fun(path):
                 continue
 
 
-def run(trees, use_deprel, probs, possdict, linearize, wn2fun):
+def run(trees, use_deprel, probs, possdict, linearize, wn2fun, k=10, beam=None):
+    """
+    prints how often the sense of the annotated lemma is among the best scored combinations of possibilities of the
+    bigrams around it (oracle), in one of them (top) and in a random one. The combinations are enumerated, or with
+    beam the k best are found by kbest_bigrams, and oracle counts the sense in any of the k.
+    """
     total = 0
     no_error = 0
     success = 0
@@ -155,24 +196,30 @@ def run(trees, use_deprel, probs, possdict, linearize, wn2fun):
         bigrams = get_bigrams_for_lemmas(lemmas, tree)
 
         pos = [(n.upostag, h.upostag) for n,h,r in bigrams]
-        
-        poss_bigrams = list(possible_bigrams(bigrams, possdict,
-            deprel=use_deprel))
-        
-        if not poss_bigrams:
-            overflow_error += 1
-            continue
 
-        if len(poss_bigrams) <= 1:
+        if beam:
+            rank = kbest_bigrams(bigrams, possdict, use_deprel, probs, k, beam)
+            n_combs = reduce(mul, (len(possdict[w]) for w in bigram_vocab(bigrams, possdict)), 1)
+            b_rand = random_bigrams(bigrams, possdict, use_deprel)
+        else:
+            poss_bigrams = list(possible_bigrams(bigrams, possdict,
+                deprel=use_deprel))
+
+            if not poss_bigrams:
+                overflow_error += 1
+                continue
+
+            n_combs = len(poss_bigrams)
+            rank = [(bigrams_prob(b, p, probs), b) 
+                    for b, p in zip(poss_bigrams, pos)]
+            rank = sorted(rank, key=lambda x: x[0])
+            p_rand, b_rand = random.choice(rank)
+
+        if n_combs <= 1:
             unambig += 1
 
         # no errors
         no_error += 1
-
-        rank = [(bigrams_prob(b, p, probs), b) 
-                for b, p in zip(poss_bigrams, pos)]
-        is_ambig = len(rank) > 1
-        rank = sorted(rank, key=lambda x: x[0])
        
         
         """ FIRST 
@@ -180,10 +227,11 @@ def run(trees, use_deprel, probs, possdict, linearize, wn2fun):
         in_top = any(w == fun or h == fun for (w, h) in first)
         """
         """ ORACLE """
-        p_rand, b_rand = random.choice(rank)
         p, top  = next(groupby(rank, lambda x: x[0]))
         top = [el for el in top]
-        in_oracle  = any(any(w[0] == fun or w[1] == fun for w in b) for p, b in top)
+        # with beam the oracle is taken over the k best, otherwise over the best scored
+        oracle = rank if beam else top
+        in_oracle  = any(any(w[0] == fun or w[1] == fun for w in b) for p, b in oracle)
         in_top = any(w[0] == fun or w[1] == fun for w in random.choice(top)[1])
         in_rand = any(w[0] == fun or w[1] == fun for w in b_rand) 
 
@@ -280,9 +328,18 @@ if __name__ == "__main__":
         type=int,
         default=1000
     )
+    parser.add_argument('--beam',
+        type=int,
+        help='find the k best combinations by a beam search of this width instead of enumerating them'
+    )
+    parser.add_argument('-k',
+        type=int,
+        default=10,
+        help='with --beam, the number of best combinations the oracle is taken over'
+    )
     args = parser.parse_args()
     with open(args.sentence_answer) as sense:
         with open(args.sentence_data) as data:
             trees = trainomatic(data, sense)
             top = islice(trees, args.num)
-            run(top, args.deprel, *init(args))
+            run(top, args.deprel, *init(args), k=args.k, beam=args.beam)
@@ -1,7 +1,7 @@
 from trainomatic import trainomatic
 from collections import defaultdict
 from itertools import product, groupby, islice
-from utils import read_probs, Word
+from utils import read_probs, Word, load_poss_dict, word_key
 from numpy import log
 import logging 
 import sys
@@ -13,23 +13,12 @@ import models
 import clust
 
 def read_poss_dict(path):
-    with open(path, encoding='utf-8') as f:
-        # format: 
-        #    columnist \t NOUN \t columnistFem_N \t columnistMasc_N
-        lines = (l.strip().split('\t') for l in f)
-        return defaultdict(lambda: [], {Word(l[0].lower(), l[1].lower()): l[2:] for l in lines})
+    # format:
+    #    columnist \t NOUN \t columnistFem_N \t columnistMasc_N
+    return load_poss_dict(path, make_key=word_key)
 
 def reverse_poss_dict(poss_dict_path):
-    out = dict()
-    with open(poss_dict_path, encoding='utf-8') as f:
-        lines = (l.strip().split('\t') for l in f)
-        for c in lines:
-            for fun in c[2:]:
-                if fun in out:
-                    out[fun].append(Word(c[0].lower(), c[1].lower()))
-                else:
-                    out[fun] = [Word(c[0].lower(), c[1].lower())]
-    return out
+    return read_poss_dict(poss_dict_path).reverse()
 
 def get_bigrams_for_lemmas(lemmas, tree):
     bigrams = [w for w in get_bigrams(tree) 
@@ -65,14 +54,11 @@ def possible_bigrams(bigrams, possdict, deprel, max_perms=1000):
 def bigrams_prob(bigrams, pos, probs):
     prob = 0
     total = 0
-    for bigram in bigrams:
-        try:
-            p = probs.get(bigram, pos)
-            if not p == 0:
-                prob += -log(p)
-                total += 1
-        except ValueError:
-            continue
+    for p in probs.get_many(bigrams, [pos] * len(bigrams)):
+        # None if no probability was found for the bigram
+        if p:
+            prob += -log(p)
+            total += 1
     if total == 0: 
         return 0
     else:
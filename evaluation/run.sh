@@ -25,6 +25,9 @@ done
 
 shift $(($OPTIND - 1))
 
+# the possibility dictionaries are read by src/poss_dict.py
+export PYTHONPATH="$(cd "$(dirname "$0")/../src" && pwd)${PYTHONPATH:+:$PYTHONPATH}"
+
 FILES="$@"
 
 for f in $FILES
@@ -76,7 +76,15 @@ def parse_args():
     )
     parser.add_argument('--skip-long',
         action='store_true',
-        help='dont try to evaluate sentences with more possibilities than num'
+        help='dont try to evaluate sentences with more possibilities than num, with --enumerate'
+    )
+    parser.add_argument('--beam',
+        type=int,
+        help='find the best combination by a beam search of this width instead of decoding it exactly'
+    )
+    parser.add_argument('--enumerate',
+        action='store_true',
+        help='rank up to num combinations of possibilities instead of decoding the best one exactly'
     )
     parser.add_argument('--model',
         choices=['unigram', 'interpolation', 'bigram'],
@@ -128,6 +136,7 @@ if __name__ == '__main__':
 
         ev = evaluation.Evaluation(args)
         for tree in tqdm(data):
-            funs = ev.annotate(tree, skip_long=args.skip_long, max_perm=args.num)
+            funs = ev.annotate(tree, skip_long=args.skip_long, max_perm=args.num,
+                    exact=not args.enumerate, beam=args.beam)
             if funs:
                 semev_output(LANG[args.lang], tree, funs)
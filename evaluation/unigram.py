@@ -1,5 +1,5 @@
 from nltk.corpus import wordnet as wn
-from utils import Word, read_probs
+from utils import load_poss_dict, word_key, read_probs
 from itertools import chain, islice, groupby
 from collections import defaultdict
 from argparse import ArgumentParser
@@ -11,23 +11,12 @@ import random
 import models
 
 def read_poss_dict(path):
-    with open(path, encoding='utf-8') as f:
-        # format: 
-        #    columnist \t NOUN \t columnistFem_N \t columnistMasc_N
-        lines = (l.strip().split('\t') for l in f)
-        return defaultdict(lambda: [], {Word(l[0].lower(), l[1].lower()): l[2:] for l in lines})
+    # format:
+    #    columnist \t NOUN \t columnistFem_N \t columnistMasc_N
+    return load_poss_dict(path, make_key=word_key)
 
 def reverse_poss_dict(poss_dict_path):
-    out = dict()
-    with open(poss_dict_path, encoding='utf-8') as f:
-        lines = (l.strip().split('\t') for l in f)
-        for c in lines:
-            for fun in c[2:]:
-                if fun in out:
-                    out[fun].append(Word(c[0].lower(), c[1].lower()))
-                else:
-                    out[fun] = [Word(c[0].lower(), c[1].lower())]
-    return out
+    return read_poss_dict(poss_dict_path).reverse()
 
 def run(trees, probs, possdict, linearize, wn2fun):
     total = 0
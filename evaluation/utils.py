@@ -4,7 +4,6 @@ try:
     from tqdm import tqdm
 except:
     tqdm = lambda x: x
-from collections import defaultdict
 import re
 from os.path import splitext
 import subprocess
@@ -99,25 +98,31 @@ def read_probs(filepath, progress_bar=False, discount=0.4):
     return d
 
 
+def lower_key(lemma, pos):
+    return lemma.lower(), pos.lower()
+
+
+def word_key(lemma, pos):
+    return Word(lemma.lower(), pos.lower())
+
+
+def load_poss_dict(path, key_columns=2, make_key=None):
+    """
+    src/poss_dict.load_poss_dict, imported when it is first used so that only the scripts that read possibility
+    dictionaries need src on the PYTHONPATH (run.sh adds it)
+    """
+    from poss_dict import load_poss_dict
+    return load_poss_dict(path, key_columns, make_key)
+
+
 def read_poss_dict(path):
-    with open(path, encoding='utf-8') as f:
-        # format: 
-        #    columnist \t NOUN \t columnistFem_N \t columnistMasc_N
-        lines = (l.strip().split('\t') for l in f)
-        return defaultdict(lambda: [], {(l[0].lower(), l[1].lower()): l[2:] for l in lines})
+    # format:
+    #    columnist \t NOUN \t columnistFem_N \t columnistMasc_N
+    return load_poss_dict(path, make_key=lower_key)
 
 def reverse_poss_dict(poss_dict_path):
-    out = dict()
-    with open(poss_dict_path, encoding='utf-8') as f:
-        lines = (l.strip().split('\t') for l in f)
-        for c in lines:
-            for fun in c[2:]:
-                if fun in out:
-                    out[fun].append((c[0].lower(), c[1].lower()))
-                else:
-                    out[fun] = [(c[0].lower(), c[1].lower())]
-    return out
-                
+    return read_poss_dict(poss_dict_path).reverse()
+
 
 def get_num_lines(file_path):
     """Return the number of lines in a file"""
@@ -1,26 +1,147 @@
 from signal import signal, SIGPIPE, SIG_DFL
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
 import argparse
+import sqlite3
+import sys
+import os
+from merge_counts import parse_fields, aggregate, write_counts
 PYTHONIOENCODING="UTF-8"
 
-signal(SIGPIPE, SIG_DFL)
-
-parser = argparse.ArgumentParser()
-parser.add_argument('directory', type=str, help='Probability directory')
-args = parser.parse_args()
-directory = args.directory
-total_count = 0
-split_counts = list()
-with open(directory+'1_splits.txt', mode='r',encoding='utf-8') as file:
-    for l in file:
-        l_split = l.strip('\n').split('\t')
-        count = int(l_split[0])
-        split = l_split[1]
-        split_counts.append((split,count))
-        total_count = total_count + count
-for split, count in split_counts:
-    with open(directory+split+'.probs', mode='r',encoding='utf-8') as file:
+delimiter = '\t'
+
+# marginal tables of bigram_deprel.probs (prob, child, head, deprel) by name, with the fields (as for cut -f) summed
+# into each. The _headuni tables are the head marginals that evaluation/models.py uses next to the bigram tables.
+MARGINALS = [('bigram', '1-3'),
+             ('unigram_deprel', '1,2,4'),
+             ('unigram', '1,2'),
+             ('bigram_headuni', '1,3'),
+             ('bigram_deprel_headuni', '1,3,4')]
+
+
+def read_splits(directory):
+    """Returns the (split, count) pairs in the 1_splits.txt file of directory and the total count"""
+    total_count = 0
+    split_counts = list()
+    with open(directory+'1_splits.txt', mode='r', encoding='utf-8') as file:
         for l in file:
             l_split = l.strip('\n').split('\t')
-            prob = float(l_split[0])
-            word = l_split[1:]
-            print(*([prob*count/total_count]+ word), sep='\t')
\ No newline at end of file
+            count = int(l_split[0])
+            split = l_split[1]
+            split_counts.append((split, count))
+            total_count = total_count + count
+    return split_counts, total_count
+
+
+def weight_split(path, count, total_count):
+    """Returns the lines of the probability file at path with the probabilities (first column) weighted by the count"""
+    with open(path, mode='r', encoding='utf-8', buffering=1 << 20) as file:
+        lines = file.read().splitlines()
+    out = list()
+    for l in lines:
+        prob, sep, word = l.partition('\t')
+        out.append(str(float(prob)*count/total_count) + sep + word)
+    return out
+
+
+def prefetch(executor, fun, tasks, ahead):
+    """Yields fun(*task) for each task in order, running up to ahead tasks in advance on executor"""
+    futures = deque()
+    for task in tasks:
+        futures.append(executor.submit(fun, *task))
+        if len(futures) > ahead:
+            yield futures.popleft().result()
+    while futures:
+        yield futures.popleft().result()
+
+
+def combine_lines(directory, jobs=4):
+    """
+    Yields the lines of the probability files of the splits in directory, one list per split, with the probabilities
+    weighted by the share of the split in the total count. The files are read by a pool of jobs threads, a few splits
+    ahead of the consumer.
+    """
+    split_counts, total_count = read_splits(directory)
+    tasks = [(directory+split+'.probs', count, total_count) for split, count in split_counts]
+    with ThreadPoolExecutor(jobs) as executor:
+        yield from prefetch(executor, weight_split, tasks, 2 * jobs)
+
+
+def write_lines(blocks, out):
+    """Writes the lists of lines in blocks to the file out, one write per list"""
+    for lines in blocks:
+        if lines:
+            out.write('\n'.join(lines) + '\n')
+
+
+def tee_rows(blocks, path):
+    """
+    Writes the lists of lines in blocks to path while yielding their rows (lists of columns), through a temporary
+    file as in merge_counts.write_counts
+    """
+    with open(path + '.tmp', mode='w', encoding='utf-8', buffering=1 << 20) as out:
+        for lines in blocks:
+            write_lines([lines], out)
+            for l in lines:
+                yield l.split(delimiter)
+    os.replace(path + '.tmp', path)
+
+
+def read_rows(path):
+    with open(path, mode='r', encoding='utf-8') as file:
+        for l in file:
+            yield l.strip('\n').split(delimiter)
+
+
+def write_marginals(directory, out_dir, memory=1 << 30, jobs=4):
+    """
+    Writes bigram_deprel.probs and the MARGINALS tables to out_dir in one pass over the combined probabilities of
+    directory. Tables that already exist are kept, and bigram_deprel.probs is read instead of recombined if it exists.
+    """
+    bigram_deprel = os.path.join(out_dir, 'bigram_deprel.probs')
+    missing = [(name, fields) for name, fields in MARGINALS
+               if not os.path.isfile(os.path.join(out_dir, name + '.probs'))]
+    if os.path.isfile(bigram_deprel):
+        if not missing:
+            return
+        rows = read_rows(bigram_deprel)
+    else:
+        rows = tee_rows(combine_lines(directory, jobs), bigram_deprel)
+    if not missing:
+        for _ in rows:
+            pass
+        return
+    print('generate', *[name for name, _ in missing], file=sys.stderr)
+    aggregators = aggregate(rows, [parse_fields(fields) for _, fields in missing], memory, out_dir, float)
+    for (name, _), aggregator in zip(missing, aggregators):
+        write_counts(aggregator, os.path.join(out_dir, name + '.probs'))
+
+
+if __name__ == '__main__':
+    signal(SIGPIPE, SIG_DFL)
+
+    parser = argparse.ArgumentParser(description="""
+    Combines the probabilities of the splits in a directory (as listed in its 1_splits.txt) into one table, weighting
+    each split by its count, and prints it. With -m the table is written to bigram_deprel.probs in the given directory
+    together with its marginal tables, summed in the same pass, and with --db it is loaded into a table of the
+    probability database read by evaluation/database.py. The split files are read by a pool of threads.
+    """)
+    parser.add_argument('directory', type=str, help='Probability directory')
+    parser.add_argument('-m', type=str, help='Write bigram_deprel.probs and its marginals to this directory')
+    parser.add_argument('--db', type=str, help='Load the table into this SQLite database')
+    parser.add_argument('--table', type=str, help='Name of the table in the database', default='bigram_deprel')
+    parser.add_argument('-j', type=int, help='Number of threads reading split files', default=4)
+    parser.add_argument('-S', type=int, help='Memory budget for the marginals in MB', default=1024)
+    args = parser.parse_args()
+    if args.m:
+        os.makedirs(args.m, exist_ok=True)
+        write_marginals(args.directory, args.m, args.S << 20, args.j)
+    elif args.db:
+        # evaluation/database.py, which needs evaluation on the PYTHONPATH
+        from database import load_table
+        conn = sqlite3.connect(args.db)
+        rows = (l.split(delimiter) for lines in combine_lines(args.directory, args.j) for l in lines)
+        load_table(conn, args.table, rows)
+        conn.close()
+    else:
+        write_lines(combine_lines(args.directory, args.j), sys.stdout)
@@ -0,0 +1,35 @@
+import json
+
+
+class EMLog:
+    """
+    Callback for the EM implementations in wn_em.py and new_em.py. Each record is a dict describing one iteration
+    (or the end of a run), it is extended with the fields given to the constructor, passed on to callback if given
+    and written as one JSON line to path if given. The records written by the EM implementations are:
+    {'event': 'iteration', 'iteration': int, 'convergence_diff': float or None for the first iteration,
+     'e_step_seconds': float, 'm_step_seconds': float,
+     'languages': [{'language': int, 'e_step_seconds': float, 'expected_count': float}, ...]}
+    {'event': 'done', 'iterations': int, 'convergence_diff': float, 'seconds': float}
+    """
+    def __init__(self, path=None, callback=None, **fields):
+        self.file = open(path, mode='a', encoding='utf-8') if path else None
+        self.callback = callback
+        self.fields = fields
+
+    def __call__(self, record):
+        record = dict(self.fields, **record)
+        if self.callback:
+            self.callback(record)
+        if self.file:
+            print(json.dumps(record), file=self.file, flush=True)
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -5,10 +5,12 @@
 #GF langs Bul Chi Dut Eng Fin Fre Ger Hin Ita Spa Swe
 #Test langs Bul Eng Fin Fre Swe
 PYTHONIOENCODING="UTF-8"
-gold_options="-l 8 -c 7 -s 2,3,6 -f 0:2,4:6" #UD Gold
-parsed_options="-l 6 -c 0 -s 2,3,5 -f 1:2,4:5" #Autoparsed
-gold_uni_options="-l 8 -c 7 -s 2,3 -f 0:2" #UD Gold
-parsed_uni_options="-l 6 -c 0 -s 2,3 -f 1:2" #Autoparsed
+gold_options="-l 8 -c 7" #UD Gold
+parsed_options="-l 6 -c 0" #Autoparsed
+gold_bi_options="-s 2,3,6 -f 0:2,4:6" #UD Gold
+parsed_bi_options="-s 2,3,5 -f 1:2,4:5" #Autoparsed
+gold_uni_options="-s 2,3 -f 0:2" #UD Gold
+parsed_uni_options="-s 2,3 -f 1:2" #Autoparsed
 wn_gf_pd_dir="../data/possibility_dictionaries/gf_wn"
 wn_pd_dir="../data/possibility_dictionaries/wn2"
 gf_pd_dir="../data/possibility_dictionaries/gf/"
@@ -17,38 +19,51 @@ clust_pd_dir="../data/possibility_dictionaries/wn_clust/"
 gold_count_dir="../data/feature_counts/UD_gold_counts"
 parsed_count_dir="../data/feature_counts/autoparsed"
 out_dir="../data/em_data/wn_udgold"
+binary="" # set to "-b" to write the binary format that run_em.py memory maps instead of gzipped tsv
+jobs=$(nproc)
+factored="" # set to "--factored" to write each position's possibilities once instead of all combinations, set it in run_em.sh as well
 
+# make_em_data COUNT_DIR COUNT_OPTIONS (PD_DIR OUT_DIR OPTIONS)...
+# Each count file is read once and written to every output directory whose possibility dictionary directory has the
+# language and that does not exist yet
 make_em_data () {
-for file in $(comm -12 <(ls $1) <(ls $2))
+local count_dir=$1 count_options=$2
+shift 2
+local outputs=("$@")
+for count_file in $count_dir/*
 do
-if [ ! -d $3/${file%.*} ]; then
-echo $3/${file%.*}
-mkdir -p $3/${file%.*}
-python ../src/make_em_data.py $4 -o $3/${file%.*} -p $1/$file $1/$file < $2/$file
-gzip -9r $3/${file%.*}
-gzip -d $3/${file%.*}/1_splits.txt.gz
+file=$(basename $count_file)
+configs=()
+for ((i=0; i<${#outputs[@]}; i+=3))
+do
+pd_dir=${outputs[i]}
+out=${outputs[i+1]}/${file%.*}
+if [ -f $pd_dir/$file ] && [ ! -d $out ]; then
+echo $out
+mkdir -p $out
+configs+=("--config=${outputs[i+2]} -o $out -p $pd_dir/$file $pd_dir/$file")
+fi
+done
+if [ ${#configs[@]} -gt 0 ]; then
+python ../src/make_em_data.py $count_options -z --jobs $jobs $binary $factored "${configs[@]}" < $count_file
 fi
 done
 }
 
-make_em_data $gf_pd_dir $gold_count_dir ../data/em_data/gf_udgold "${gold_options}"
-make_em_data $gf_pd_dir $gold_count_dir ../data/em_data/gf_udgold_uni "${gold_uni_options}"
-
-make_em_data $wn_gf_pd_dir $gold_count_dir ../data/em_data/wn_udgold "${gold_options}"
-make_em_data $wn_gf_pd_dir $gold_count_dir ../data/em_data/wn_udgold_uni "${gold_uni_options}"
-
-make_em_data $kras_pd_dir $gold_count_dir ../data/em_data/kras_udgold "${gold_options}"
-make_em_data $kras_pd_dir $gold_count_dir ../data/em_data/kras_udgold_uni "${gold_uni_options}"
-
-make_em_data $gf_pd_dir $parsed_count_dir/th050 ../data/em_data/gf_autoparsed_th50 "${parsed_options}"
-make_em_data $gf_pd_dir $parsed_count_dir/th050 ../data/em_data/gf_autoparsed_th50_uni "${parsed_uni_options}"
-
-make_em_data $wn_gf_pd_dir $parsed_count_dir/th050 ../data/em_data/wn_autoparsed_th50 "${parsed_options}"
-make_em_data $wn_gf_pd_dir $parsed_count_dir/th050 ../data/em_data/wn_autoparsed_th50_uni "${parsed_uni_options}"
-
-make_em_data $kras_pd_dir $parsed_count_dir/th050 ../data/em_data/kras_autoparsed_th50 "${parsed_options}"
-make_em_data $kras_pd_dir $parsed_count_dir/th050 ../data/em_data/kras_autoparsed_th50_uni "${parsed_uni_options}"
-
-make_em_data $clust_pd_dir $parsed_count_dir/th050 ../data/em_data/clust_autoparsed_th50 "${parsed_options}"
-make_em_data $clust_pd_dir $parsed_count_dir/th050 ../data/em_data/clust_autoparsed_th50_uni "${parsed_uni_options}"
+make_em_data $gold_count_dir "${gold_options}" \
+    $gf_pd_dir ../data/em_data/gf_udgold "${gold_bi_options}" \
+    $gf_pd_dir ../data/em_data/gf_udgold_uni "${gold_uni_options}" \
+    $wn_gf_pd_dir ../data/em_data/wn_udgold "${gold_bi_options}" \
+    $wn_gf_pd_dir ../data/em_data/wn_udgold_uni "${gold_uni_options}" \
+    $kras_pd_dir ../data/em_data/kras_udgold "${gold_bi_options}" \
+    $kras_pd_dir ../data/em_data/kras_udgold_uni "${gold_uni_options}"
 
+make_em_data $parsed_count_dir/th050 "${parsed_options}" \
+    $gf_pd_dir ../data/em_data/gf_autoparsed_th50 "${parsed_bi_options}" \
+    $gf_pd_dir ../data/em_data/gf_autoparsed_th50_uni "${parsed_uni_options}" \
+    $wn_gf_pd_dir ../data/em_data/wn_autoparsed_th50 "${parsed_bi_options}" \
+    $wn_gf_pd_dir ../data/em_data/wn_autoparsed_th50_uni "${parsed_uni_options}" \
+    $kras_pd_dir ../data/em_data/kras_autoparsed_th50 "${parsed_bi_options}" \
+    $kras_pd_dir ../data/em_data/kras_autoparsed_th50_uni "${parsed_uni_options}" \
+    $clust_pd_dir ../data/em_data/clust_autoparsed_th50 "${parsed_bi_options}" \
+    $clust_pd_dir ../data/em_data/clust_autoparsed_th50_uni "${parsed_uni_options}"
@@ -1,11 +1,318 @@
 from itertools import product
+from collections import OrderedDict
+import gzip
+from array import array
+from poss_dict import load_poss_dict
+import numpy as np
 import sys
+import os
+import stat
+import shutil
 import argparse
+from multiprocessing import Pool
 PYTHONIOENCODING="UTF-8"
 
 
+class BinarySplit:
+    """
+    Binary EM data for one split, read by wn_em.read_em_binary. Each possible function n-gram is interned to an id
+    in the order it is first seen and the rows are stored CSR-style: the possibilities of row i are
+    funs[offsets[i]:offsets[i+1]]. Written as <prefix>.counts.npy, <prefix>.offsets.npy, <prefix>.funs.npy and the
+    function table <prefix>.funtable.tsv with the columns of function id i on line i.
+    """
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.fun2id = dict()
+        self.id2fun = list()
+        self.counts = array('q')
+        self.offsets = array('q', [0])
+        self.funs = array('i')
 
-parser = argparse.ArgumentParser(description='''
+    def add(self, count, fun_ngrams):
+        for fun in fun_ngrams:
+            if fun not in self.fun2id:
+                self.fun2id[fun] = len(self.id2fun)
+                self.id2fun.append(fun)
+            self.funs.append(self.fun2id[fun])
+        self.counts.append(count)
+        self.offsets.append(len(self.funs))
+
+    def extend(self, prefix):
+        """Appends the rows of the binary split written to prefix, with its functions interned into this one"""
+        local2global = array('i')
+        with open(prefix + '.funtable.tsv', mode='r', encoding='utf-8') as file:
+            for l in file:
+                fun = tuple(l.strip('\n').split('\t'))
+                if fun not in self.fun2id:
+                    self.fun2id[fun] = len(self.id2fun)
+                    self.id2fun.append(fun)
+                local2global.append(self.fun2id[fun])
+        local2global = np.frombuffer(local2global, dtype=np.int32)
+        self.counts.frombytes(np.load(prefix + '.counts.npy').astype(np.int64).tobytes())
+        self.offsets.frombytes((np.load(prefix + '.offsets.npy')[1:] + self.offsets[-1]).astype(np.int64).tobytes())
+        self.funs.frombytes(local2global[np.load(prefix + '.funs.npy')].astype(np.int32).tobytes())
+
+    def close(self):
+        np.save(self.prefix + '.counts.npy', np.frombuffer(self.counts, dtype=np.int64))
+        np.save(self.prefix + '.offsets.npy', np.frombuffer(self.offsets, dtype=np.int64))
+        np.save(self.prefix + '.funs.npy', np.frombuffer(self.funs, dtype=np.int32))
+        with open(self.prefix + '.funtable.tsv', mode='w', encoding='utf-8') as file:
+            for fun in self.id2fun:
+                print(*fun, sep='\t', file=file)
+
+
+class WriterPool:
+    """
+    Writes text to many files with at most max_open of them open at a time, the least recently written one is closed
+    when another has to be opened. Text is buffered per file and written when buffer_size characters have gathered and
+    at close. A file that is written again after being closed is appended to, gzipped files get a new gzip member,
+    which gzip, zcat and gzip.open read as one stream.
+    """
+    def __init__(self, compress=False, max_open=64, buffer_size=1 << 16):
+        self.compress = compress
+        self.max_open = max_open
+        self.buffer_size = buffer_size
+        self.buffers = dict()
+        self.buffered = dict()
+        self.open_files = OrderedDict()
+        self.created = set()
+
+    def write(self, path, text):
+        if path not in self.buffers:
+            self.buffers[path] = list()
+            self.buffered[path] = 0
+        self.buffers[path].append(text)
+        self.buffered[path] = self.buffered[path] + len(text)
+        if self.buffered[path] >= self.buffer_size:
+            self.flush(path)
+
+    def flush(self, path):
+        file = self.open_files.get(path)
+        if file is None:
+            if len(self.open_files) >= self.max_open:
+                self.open_files.popitem(last=False)[1].close()
+            # the first write to a file truncates it, the following ones append
+            mode = 'at' if path in self.created else 'wt'
+            self.created.add(path)
+            if self.compress:
+                file = gzip.open(path, mode=mode, encoding='utf-8')
+            else:
+                file = open(path, mode=mode, encoding='utf-8')
+            self.open_files[path] = file
+        else:
+            self.open_files.move_to_end(path)
+        file.write(''.join(self.buffers[path]))
+        self.buffers[path] = list()
+        self.buffered[path] = 0
+
+    def close(self):
+        for path in self.buffers:
+            if self.buffers[path]:
+                self.flush(path)
+        for file in self.open_files.values():
+            file.close()
+        self.open_files = OrderedDict()
+
+class EMData:
+    """
+    The EM data of one configuration: the rows of the count file with the possibilities of their features looked up in
+    poss_dicts, written through the WriterPool writers to one file per split (the values of splitcols) in outpath, and
+    the total count of each split to 1_splits.txt when closed.
+    """
+    def __init__(self, outpath, poss_dicts, feature_columns, splitcols, writers, root='ROOT', oov=None, binary=False,
+                 factored=False):
+        self.outpath = outpath
+        self.poss_dicts = poss_dicts
+        self.feature_columns = feature_columns
+        self.splitcols = splitcols
+        self.root = root
+        self.oov = oov
+        self.binary = binary
+        self.factored = factored
+        self.writers = writers
+        self.file_pool = dict()
+        self.split_counts = dict()
+
+    def open_split(self, split_id):
+        if self.binary:
+            return BinarySplit(self.outpath + '/' + '_'.join(split_id))
+        path = self.outpath + '/' + '_'.join(split_id) + ('.txt.gz' if self.writers.compress else '.txt')
+        self.writers.write(path, '---\n')
+        return path
+
+    def add(self, l_split, count):
+        multigram_possibilities = []
+        multigram_features = []
+        for pd, f_cols in zip(self.poss_dicts, self.feature_columns):
+            feature = tuple([l_split[col] for col in f_cols])
+
+            if feature in pd:
+                #Feature in vocabulary
+                possibilities = pd[feature]
+            elif any([l_split[col] == 'ROOT' for col in f_cols]):
+                #Root
+                possibilities = [self.root]
+            elif self.oov is not None:
+                #OOV This is not a good idea as it needs a recount
+                possibilities = '_'.join([self.oov]+[l_split[col] for col in f_cols[1:]])
+            else:
+                #OOV and skip OOV
+                return
+            multigram_features.append(feature)
+            multigram_possibilities.append(possibilities)
+
+        split_id = tuple([l_split[col] for col in self.splitcols])
+
+        if split_id not in self.file_pool.keys():
+            self.file_pool[split_id] = self.open_split(split_id)
+            self.split_counts[split_id] = 0
+        self.split_counts[split_id] = self.split_counts[split_id] + count
+        if self.binary:
+            self.file_pool[split_id].add(count, product(*multigram_possibilities))
+            return
+
+        if self.factored:
+            multigram_possibilities = [column for possibilities in multigram_possibilities
+                                       for column in [len(possibilities)] + list(possibilities)]
+        else:
+            multigram_possibilities = [unigram for ngram in product(*multigram_possibilities) for unigram in ngram]
+        multigram_features = [f_col for feature in multigram_features for f_col in feature]
+        self.writers.write(self.file_pool[split_id],
+                           '\t'.join(map(str, [count]+multigram_features+multigram_possibilities)) + '\n')
+
+    def close(self):
+        if self.binary:
+            for file in self.file_pool.values():
+                file.close()
+        with open(self.outpath + '/' + '1_splits.txt', mode='w+', encoding='utf-8') as f:
+            for split, count in self.split_counts.items():
+                print(count,'_'.join(split), sep='\t', file=f)
+
+
+def make_em_data(lines, configurations, writers, options):
+    """
+    Writes the EM data of each configuration (the -s, -f, -o and -p options of one output) for the count file rows in
+    lines, options are the other command line options
+    """
+    em_data = list()
+    for config in configurations:
+        feature_columns = [[int(col) for col in feature.split(':')] for feature in config.f.split(',')]
+        poss_dicts = [load_poss_dict(path, len(cols)) for path, cols in zip(config.p, feature_columns)]
+        em_data.append(EMData(config.o, poss_dicts, feature_columns, [int(col) for col in config.s.split(',')],
+                              writers, root=options.r, oov=options.m, binary=options.b, factored=options.factored))
+    for l in lines:
+        l_split = l.strip('\n').split('\t')
+
+        if len(l_split) < options.l and options.l>0:
+            l_split = l_split + [options.r]*(options.l-len(l_split))
+        count = int(l_split[options.c])
+        for data in em_data:
+            data.add(l_split, count)
+
+    writers.close()
+    for data in em_data:
+        data.close()
+
+
+def shard_boundaries(fd, jobs):
+    """Splits the file fd into at most jobs byte ranges of about the same size that start at the start of a line"""
+    size = os.fstat(fd).st_size
+    starts = [0]
+    for k in range(1, jobs):
+        position = max(k * size // jobs, starts[-1])
+        # move to the start of the next line, unless position already is one
+        while 0 < position < size and os.pread(fd, 1, position - 1) != b'\n':
+            block = os.pread(fd, 1 << 16, position)
+            newline = block.find(b'\n')
+            position = position + len(block) if newline == -1 else position + newline + 1
+        starts.append(position)
+    starts.append(size)
+    return [(start, end) for start, end in zip(starts[:-1], starts[1:]) if start < end]
+
+
+def read_lines(fd, start, end, block_size=1 << 20):
+    """
+    Yields the lines in the byte range [start, end) of the file fd, read with os.pread so that the processes reading
+    the shards can share the descriptor
+    """
+    rest = b''
+    while start < end:
+        block = os.pread(fd, min(block_size, end - start), start)
+        if not block:
+            break
+        start = start + len(block)
+        lines = (rest + block).split(b'\n')
+        rest = lines.pop()
+        for line in lines:
+            yield line.decode('utf-8') + '\n'
+    if rest:
+        yield rest.decode('utf-8')
+
+
+def shard_path(outpath, shard):
+    return os.path.join(outpath, '.shard{}'.format(shard))
+
+
+def make_em_data_shard(task):
+    """Writes the EM data of the rows in one byte range of fd uncompressed to a shard directory of each output"""
+    shard, (start, end), fd, configurations, options = task
+    shard_configurations = list()
+    for config in configurations:
+        shard_config = argparse.Namespace(**vars(config))
+        shard_config.o = shard_path(config.o, shard)
+        os.makedirs(shard_config.o)
+        shard_configurations.append(shard_config)
+    make_em_data(read_lines(fd, start, end), shard_configurations, WriterPool(max_open=options.w), options)
+
+
+def merge_shards(outpath, shards, writers, binary=False):
+    """
+    Concatenates the split files of the shard directories of outpath in shard order and sums their split counts, the
+    splits are ordered by where they are first seen, so the result is the same as for a serial run
+    """
+    split_counts = dict()
+    for shard in range(shards):
+        with open(os.path.join(shard_path(outpath, shard), '1_splits.txt'), mode='r', encoding='utf-8') as f:
+            for l in f:
+                count, split = l.strip('\n').split('\t')
+                split_counts[split] = split_counts.get(split, 0) + int(count)
+    for split in split_counts:
+        if binary:
+            out = BinarySplit(os.path.join(outpath, split))
+            for shard in range(shards):
+                prefix = os.path.join(shard_path(outpath, shard), split)
+                if os.path.isfile(prefix + '.counts.npy'):
+                    out.extend(prefix)
+            out.close()
+            continue
+        path = os.path.join(outpath, split + ('.txt.gz' if writers.compress else '.txt'))
+        writers.write(path, '---\n')
+        for shard in range(shards):
+            shard_file = os.path.join(shard_path(outpath, shard), split + '.txt')
+            if os.path.isfile(shard_file):
+                with open(shard_file, mode='r', encoding='utf-8') as f:
+                    f.readline()
+                    for block in iter(lambda: f.read(1 << 20), ''):
+                        writers.write(path, block)
+    writers.close()
+    with open(os.path.join(outpath, '1_splits.txt'), mode='w+', encoding='utf-8') as f:
+        for split, count in split_counts.items():
+            print(count, split, sep='\t', file=f)
+    for shard in range(shards):
+        shutil.rmtree(shard_path(outpath, shard))
+
+
+def add_configuration_arguments(parser, required=True):
+    parser.add_argument('-s', type=str, help='Split columns, comma separated', default='')
+    parser.add_argument('-f', type=str, help='Feature columns, features comma separated, columns : separated',
+                        required=required)
+    parser.add_argument('-o', type=str, help='Output directory', required=required)
+    parser.add_argument('-p', type=str, nargs='+', help='List of possibility dicts, one for each feature',
+                        required=required)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='''
 This script generates data files to be fed to wn_em.py or new_em.py from a possibility dictionary and count files in tsv format.
  Specify which columns are feature columns with the f flag. In an n-gram model, each lexical item is separated with : and
  each feature within these lexical items separated by ,. The data is written to separate files based on the columns given 
@@ -14,87 +321,56 @@ This script generates data files to be fed to wn_em.py or new_em.py from a possi
   lexical items having their possibility info taken from the possibility dictionary dict.tsv and one wants to split the 
   data into separate files according to deprel the script can be run with:
   python make_em_data -c 0 -s 3 -f 1:2,4:5 -p dict.tsv dict.tsv" 
+  Several outputs can be made from one pass over the count file by giving the -s, -f, -o and -p options of each of
+  them as one --config argument instead, e.g. --config="-s 3 -f 1:2,4:5 -o bigrams -p dict.tsv dict.tsv"
+  --config="-s 3 -f 1:2 -o unigrams -p dict.tsv".
+  Large count files can be processed by several processes with --jobs, the input then has to be a regular file
+  (e.g. redirected with <) and the output is the same as without.
   Please refer to make_all_em_data.sh for further examples of usage.
 ''')
-parser.add_argument('-l', type=int, help='Number of fields of proper rows, rows with fewer columns will be filled with root symbols.', default=0)
-parser.add_argument('-r', type=str, help='Root symbol', default='ROOT')
-parser.add_argument('-m', type=str, help='Out of vocabulary items will be given this value in first feature column,other feature columns are carried', default=None)
-parser.add_argument('-c', type=int, help='Count column, one column, -1 chooses last column automatically', required=True)
-parser.add_argument('-s', type=str, help='Split columns, comma separated', default='')
-parser.add_argument('-f', type=str, help='Feature columns, features comma separated, columns : separated', required=True)
-parser.add_argument('-o', type=str, help='Output directory', required=True)
-parser.add_argument('-i', type=str, help='Identity columns, will be carried without dictionary')
-parser.add_argument('-p', type=argparse.FileType(mode='r', encoding='utf-8'), nargs='+', help='List of possibility dicts, one for each feature', required=True)
-args = parser.parse_args()
-poss_dicts = list()
-splitcols = [int(col) for col in args.s.split(',')]
-feature_columns = [[int(col) for col in feature.split(':')] for feature in args.f.split(',')]
-count_column = args.c
-outpath = args.o
-row_length = args.l
-if count_column == -1 and args.l != 0:
-    print('Using -l >0 with -c = -1 is not supported.', file=sys.stderr)
-    quit(1)
-
-for file, cols in zip(args.p, feature_columns):
-    possibilities = dict()
-    for l in file:
-        l_split = l.strip('\n').split('\t')
-        word = tuple(l_split[:len(cols)])
-        funs = l_split[len(cols):]
-        if word in possibilities.keys():
-            possibilities[word]=list(set(possibilities[word]+funs))
-        else:
-            possibilities[word] = funs
-    poss_dicts.append(possibilities)
-file_pool=dict()
-split_counts = dict()
-for l in sys.stdin:
-    l_split = l.strip('\n').split('\t')
-
-    if len(l_split) < row_length and row_length>0:
-        l_split = l_split + [args.r]*(row_length-len(l_split))
-    count = int(l_split[count_column])
-    multigram_possibilities = []
-    multigram_features = []
-    skip = False
-    for pd, f_cols in zip(poss_dicts, feature_columns):
-        feature = tuple([l_split[col] for col in f_cols])
-
-        if feature in pd.keys():
-            #Feature in vocabulary
-            possibilities = pd[feature]
-        elif any([l_split[col] == 'ROOT' for col in f_cols]):
-            #Root
-            possibilities = [args.r]
-        elif args.m is not None:
-            #OOV This is not a good idea as it needs a recount
-            possibilities = '_'.join([args.m]+[l_split[col] for col in f_cols[1:]])
-        else:
-            #OOV and skip OOV
-            skip = True
-            break
-        multigram_features.append(feature)
-        multigram_possibilities.append(possibilities)
-    if skip is True:
-        #print(l_split, file=sys.stderr)
-        continue
-
-    multigram_possibilities = [unigram for ngram in product(*multigram_possibilities) for unigram in ngram]
-    multigram_features = [f_col for feature in multigram_features for f_col in feature]
-    split_id = tuple([l_split[col] for col in splitcols])
-
-    if split_id not in file_pool.keys():
-        file_name = '_'.join(split_id) + '.txt'
-        file = open(outpath + '/' + file_name, mode='w+', encoding='utf-8')
-        print('---', file=file)
-        file_pool[split_id] = file
-        split_counts[split_id] = 0
-    split_counts[split_id] = split_counts[split_id] + count
-    print(*([count]+multigram_features+multigram_possibilities), sep='\t', file=file_pool[split_id])
-
-for file in file_pool.values():
-    file.close()
-with open(outpath + '/' + '1_splits.txt', mode='w+', encoding='utf-8') as f:
-    for split, count in split_counts.items():
-        print(count,'_'.join(split), sep='\t', file=f)
+    parser.add_argument('-l', type=int, help='Number of fields of proper rows, rows with fewer columns will be filled with root symbols.', default=0)
+    parser.add_argument('-r', type=str, help='Root symbol', default='ROOT')
+    parser.add_argument('-m', type=str, help='Out of vocabulary items will be given this value in first feature column,other feature columns are carried', default=None)
+    parser.add_argument('-c', type=int, help='Count column, one column, -1 chooses last column automatically', required=True)
+    add_configuration_arguments(parser, required=False)
+    parser.add_argument('--config', type=str, action='append', default=[],
+                        help='The -s, -f, -o and -p options of one output, can be given several times')
+    parser.add_argument('-i', type=str, help='Identity columns, will be carried without dictionary')
+    parser.add_argument('-b', action='store_true', help='Write the binary format (see BinarySplit) instead of tsv')
+    parser.add_argument('--factored', action='store_true',
+                        help='Write the possibilities of each position once, as their number followed by the possibilities, '
+                             'instead of all combinations. Read with --factored in wn_em.py, run_em.py and new_em.py')
+    parser.add_argument('-z', action='store_true', help='Write the tsv files gzipped (as <split>.txt.gz)')
+    parser.add_argument('-w', type=int, help='Maximum number of output files open at a time', default=64)
+    parser.add_argument('--jobs', type=int, help='Number of processes, each reading one part of the input', default=1)
+    args = parser.parse_args()
+    if args.b and args.factored:
+        parser.error('-b can not be combined with --factored')
+    config_parser = argparse.ArgumentParser(prog='--config')
+    add_configuration_arguments(config_parser)
+    if args.config:
+        configurations = [config_parser.parse_args(config.split()) for config in args.config]
+    elif args.f and args.o and args.p:
+        configurations = [args]
+    else:
+        parser.error('the -f, -o and -p options or --config are required')
+    if args.c == -1 and args.l != 0:
+        print('Using -l >0 with -c = -1 is not supported.', file=sys.stderr)
+        quit(1)
+
+    writers = WriterPool(compress=args.z, max_open=args.w)
+    if args.jobs > 1:
+        if not stat.S_ISREG(os.fstat(sys.stdin.fileno()).st_mode):
+            parser.error('--jobs needs a regular file as input')
+        # parse the possibility dictionaries once here, the workers load them from the cache
+        for config in configurations:
+            for path, feature in zip(config.p, config.f.split(',')):
+                load_poss_dict(path, len(feature.split(':')))
+        shards = shard_boundaries(sys.stdin.fileno(), args.jobs)
+        with Pool(len(shards)) as pool:
+            pool.map(make_em_data_shard, [(shard, byte_range, sys.stdin.fileno(), configurations, args)
+                                          for shard, byte_range in enumerate(shards)])
+        for config in configurations:
+            merge_shards(config.o, len(shards), writers, args.b)
+    else:
+        make_em_data(sys.stdin, configurations, writers, args)
@@ -1,40 +1,171 @@
 from signal import signal, SIGPIPE, SIG_DFL
+from operator import itemgetter
+import tempfile
 import argparse
+import heapq
 import sys
+import os
 
 #Count should always be on first column
 
 delimiter= '\t'
 #count_col=0
 
-signal(SIGPIPE, SIG_DFL)
-
-parser = argparse.ArgumentParser()
-parser.add_argument('-f', action='store_true')
-parser.add_argument('-c', action='store_true')
-args = parser.parse_args()
-
-counts = dict()
-current = None
-current_count = 0
-for l in sys.stdin:
-    l_split = l.strip('\n').split(delimiter)
-    if not args.c:
-        count = l_split[0]
-        feature = tuple(l_split[1:])
-    else:
-        count = l_split[-1]
-        feature = tuple(l_split[:-1])
-    if args.f:
-        count = float(count)
-    else:
-        count = int(count)
-    if feature != current:
-        if current is not None:
-            print(*([current_count]+list(current)), sep=delimiter)
-        current = feature
-        current_count = count
+
+def parse_fields(fields):
+    """
+    Parses a field list in the syntax of cut -f (1-based, e.g. 1-3 or 1,2,4 or 2-) into a function from the columns of
+    a row to the selected columns
+    """
+    ranges = list()
+    for part in fields.split(','):
+        if '-' in part:
+            start, end = part.split('-')
+            ranges.append((int(start) - 1 if start else 0, int(end) if end else None))
+        else:
+            ranges.append((int(part) - 1, int(part)))
+    return lambda l_split: [column for start, end in ranges for column in l_split[start:end]]
+
+
+def merge_sorted(rows):
+    """Sums the counts of consecutive rows with the same feature, rows are (feature, count) pairs"""
+    current = None
+    current_count = 0
+    for feature, count in rows:
+        if feature != current:
+            if current is not None:
+                yield current, current_count
+            current = feature
+            current_count = count
+        else:
+            current_count = current_count + count
+    if current is not None:
+        yield current, current_count
+
+
+class Aggregator:
+    """
+    Sums the counts of each feature in a dict. When the features take more than about memory bytes the dict is
+    written sorted to a temporary file (a run) and emptied, iterating gives the features in sorted order with their
+    total counts by a k-way merge of the runs and the dict, so the input does not have to be sorted. At most max_runs
+    runs are kept open, when there are more they are merged into one.
+    """
+    def __init__(self, memory=1 << 30, tmpdir=None, parse_count=int, max_runs=64):
+        self.memory = memory
+        self.max_runs = max_runs
+        self.tmpdir = tmpdir
+        self.parse_count = parse_count
+        self.counts = dict()
+        self.size = 0
+        self.runs = list()
+
+    def add(self, feature, count):
+        if feature in self.counts:
+            self.counts[feature] = self.counts[feature] + count
+        else:
+            self.counts[feature] = count
+            # rough size of a dict entry with a tuple of strings as key
+            self.size = self.size + 200 + sum(len(column) for column in feature)
+            if self.size > self.memory:
+                self.spill()
+
+    def write_run(self, rows):
+        """Writes the sorted (feature, count) rows to a new run and returns it, positioned at the start"""
+        run = tempfile.TemporaryFile(mode='w+', encoding='utf-8', dir=self.tmpdir)
+        for feature, count in rows:
+            print(*([count] + list(feature)), sep=delimiter, file=run)
+        run.seek(0)
+        return run
+
+    def spill(self):
+        self.runs.append(self.write_run(sorted(self.counts.items(), key=itemgetter(0))))
+        self.counts = dict()
+        self.size = 0
+        if len(self.runs) >= self.max_runs:
+            runs = [self.read_run(run) for run in self.runs]
+            self.runs = [self.write_run(merge_sorted(heapq.merge(*runs, key=itemgetter(0))))]
+
+    def read_run(self, run):
+        for l in run:
+            l_split = l.strip('\n').split(delimiter)
+            yield tuple(l_split[1:]), self.parse_count(l_split[0])
+        run.close()
+
+    def __iter__(self):
+        in_memory = sorted(self.counts.items(), key=itemgetter(0))
+        self.counts = dict()
+        runs = [self.read_run(run) for run in self.runs]
+        self.runs = list()
+        return merge_sorted(heapq.merge(in_memory, *runs, key=itemgetter(0)))
+
+
+def aggregate(rows, projections, memory=1 << 30, tmpdir=None, parse_count=int, count_last=False):
+    """
+    Sums the counts of rows (lists of columns) for each projection (a function from the columns of a row to the
+    columns kept, see parse_fields) in one pass, the count is the first (or with count_last the last) of the kept
+    columns.
+    :return: one Aggregator for each projection, sharing the memory budget
+    """
+    aggregators = [Aggregator(memory // len(projections), tmpdir, parse_count) for _ in projections]
+    for l_split in rows:
+        for project, aggregator in zip(projections, aggregators):
+            columns = project(l_split)
+            if count_last:
+                aggregator.add(tuple(columns[:-1]), parse_count(columns[-1]))
+            else:
+                aggregator.add(tuple(columns[1:]), parse_count(columns[0]))
+    return aggregators
+
+
+def write_counts(counts, path):
+    """Writes the (feature, count) pairs to path, through a temporary file so that path only exists when complete"""
+    with open(path + '.tmp', mode='w', encoding='utf-8') as out:
+        for feature, count in counts:
+            print(*([count]+list(feature)), sep=delimiter, file=out)
+    os.replace(path + '.tmp', path)
+
+
+if __name__ == '__main__':
+    signal(SIGPIPE, SIG_DFL)
+
+    parser = argparse.ArgumentParser(description="""
+    Sums the counts (first column) of rows with the same features (the other columns). By default the rows have to be
+    sorted so that equal features are consecutive. With -u or -k the input can be in any order: the counts are summed
+    in memory, sorted runs are written to temporary files when over the memory budget and merged at the end, and the
+    output is sorted. Each -k gives the fields (as for cut -f) of one projection, several of them are done in one
+    pass over the input and written to the files given with -o in the same order.
+    """)
+    parser.add_argument('-f', action='store_true', help='Counts are floats')
+    parser.add_argument('-c', action='store_true', help='Count is the last column instead of the first')
+    parser.add_argument('-u', action='store_true', help='The input is not sorted')
+    parser.add_argument('-k', type=str, action='append', default=[],
+                        help='Fields of a projection, as for cut -f (e.g. 1-3 or 1,2,4), implies -u')
+    parser.add_argument('-o', type=str, action='append', default=[],
+                        help='Output file for each projection, standard output if only one projection is given')
+    parser.add_argument('-S', type=int, help='Memory budget in MB', default=1024)
+    parser.add_argument('-T', type=str, help='Directory for temporary files', default=None)
+    args = parser.parse_args()
+    parse_count = float if args.f else int
+
+    if args.u or args.k:
+        projections = [parse_fields(fields) for fields in args.k] if args.k else [lambda l_split: l_split]
+        if len(args.o) != len(projections) and not (len(projections) == 1 and not args.o):
+            parser.error('give one -o for each -k')
+        if args.T:
+            os.makedirs(args.T, exist_ok=True)
+        rows = (l.strip('\n').split(delimiter) for l in sys.stdin)
+        aggregators = aggregate(rows, projections, args.S << 20, args.T, parse_count, args.c)
+        for i, aggregator in enumerate(aggregators):
+            if args.o:
+                write_counts(aggregator, args.o[i])
+            else:
+                for feature, count in aggregator:
+                    print(*([count]+list(feature)), sep=delimiter)
     else:
-        current_count = current_count + count
-#Print the last value
-print(*([current_count]+list(current)), sep=delimiter)
+        rows = (l.strip('\n').split(delimiter) for l in sys.stdin)
+        if not args.c:
+            rows = ((tuple(l_split[1:]), parse_count(l_split[0])) for l_split in rows)
+        else:
+            rows = ((tuple(l_split[:-1]), parse_count(l_split[-1])) for l_split in rows)
+        for feature, count in merge_sorted(rows):
+            print(*([count]+list(feature)), sep=delimiter)
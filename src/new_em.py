@@ -1,7 +1,31 @@
 from itertools import product
-from collections import defaultdict
-from math import log
+from array import array
+import numpy as np
+import time
 import sys
+from em_log import EMLog
+from poss_dict import load_poss_dict
+
+# the number of candidates generated at once by update_counts, which bounds the memory of an iteration
+CHUNK_SIZE = 1 << 20
+# the number of candidates kept between iterations, the candidates of the other chunks are generated again each time
+CACHE_SIZE = 1 << 22
+# the index of the nonzero fun ngram counts is rebuilt once fewer than this fraction of its entries are nonzero
+COMPACT_FRACTION = 0.9
+
+
+def expand_ranges(starts, sizes):
+    """returns for the ranges [start, start + size) the number of the range of each of their elements, and the
+    elements"""
+    owners = np.repeat(np.arange(sizes.size), sizes)
+    offsets = np.cumsum(sizes) - sizes
+    return owners, starts[owners] + np.arange(owners.size) - offsets[owners]
+
+
+def chunk_ngrams(costs):
+    """splits the ngrams into consecutive chunks of about CHUNK_SIZE in total cost, at least one ngram each"""
+    labels = (np.cumsum(costs) - costs) // CHUNK_SIZE
+    return np.split(np.arange(costs.size), np.flatnonzero(np.diff(labels)) + 1)
 
 
 class EM:
@@ -9,7 +33,8 @@ class EM:
     def __init__(self, poss_dict_by_lang_and_ngram_position,
                  counts_by_lang,
                  ngrams_by_lang,
-                 convergence_threshold=1e-5):
+                 convergence_threshold=1e-5,
+                 prune=0.0):
         self.poss_dict_by_lang_and_ngram_position = poss_dict_by_lang_and_ngram_position
         self.counts_by_lang = counts_by_lang
         self.total_counts = sum([sum(counts) for counts in counts_by_lang])
@@ -17,99 +42,330 @@ class EM:
         self.langs = len(poss_dict_by_lang_and_ngram_position)
         self.positions = len(poss_dict_by_lang_and_ngram_position[0])
         self.convergence_threshold=convergence_threshold
+        self.prune = prune
+        self.fun2id = dict()
+        self.id2fun = list()
+        self.slot_langs = [array('q') for _ in range(self.positions)]
+        self.slot_funs = [array('q') for _ in range(self.positions)]
+        self.slot_words = [array('q') for _ in range(self.positions)]
+        self.slots_by_lang = [self.enumerate_slots(s) for s in range(self.langs)]
+        self.slot_langs = [np.frombuffer(langs, dtype=np.int64) for langs in self.slot_langs]
+        self.slot_funs = [np.frombuffer(funs, dtype=np.int64) for funs in self.slot_funs]
+        self.slot_words = [np.frombuffer(words, dtype=np.int64) for words in self.slot_words]
+        # a fun ngram is coded as a number in base radix, its first fun being the most significant digit
+        self.radix = max(len(self.id2fun), 1)
+        if self.radix ** self.positions >= 2 ** 63:
+            raise ValueError('{} funs are too many to code {}-grams of them'.format(self.radix, self.positions))
+        self.slot_lang_funs = [None] * self.positions
+        self.intern_lang_funs()
+        self.slot_keys = [None] * self.positions
+        self.slot_key_ids = [None] * self.positions
+        self.index_slots()
+        self.fun_ngram_codes = None
+        self.intern_fun_ngrams()
+        self.index_ids = None
+        self.index_codes = None
+        self.index_offsets = None
+        self.slot_index_offsets = None
+        self.cache = dict()
+        self.cached = 0
         self.word_conditionals = None
         self.fun_by_lang_and_position = None
         self.fun_ngram_counts = None
-        self.init_counters()
+        self.slot_conditionals = None
         self.new_word_conditionals = None
         self.new_fun_by_lang_and_position = None
         self.new_fun_ngram_counts = None
-
-    def run(self):
+        self.init_counters()
+        self.index_fun_ngrams()
+
+    def enumerate_slots(self, lang):
+        """
+        Gives every possibility of a word of lang at a position a slot, the id of a (lang, word, fun) triple for that
+        position, so the probability of a candidate fun ngram of an ngram factorizes over its slots and the fun ngram
+        count. The slots of a word are consecutive ids, given when the word is first seen in lang at that position,
+        and slot_words maps them to the first one. The candidates themselves are not stored: update_counts generates
+        them a chunk of ngrams at a time, see product_candidates and indexed_candidates.
+        :return: dict with the counts and, by position and ngram, the first slot and the number of slots of the word
+        """
+        ngrams = self.ngrams_by_lang[lang]
+        poss_dicts = self.poss_dict_by_lang_and_ngram_position[lang]
+        starts = np.zeros([self.positions, len(ngrams)], dtype=np.int64)
+        sizes = np.zeros([self.positions, len(ngrams)], dtype=np.int64)
+        word_slots = [dict() for _ in range(self.positions)]
+        for n, ngram in enumerate(ngrams):
+            for i, (word, poss_dict) in enumerate(zip(ngram, poss_dicts)):
+                if word not in word_slots[i]:
+                    first = len(self.slot_funs[i])
+                    word_slots[i][word] = (first, len(poss_dict[word]))
+                    for fun in poss_dict[word]:
+                        if fun not in self.fun2id:
+                            self.fun2id[fun] = len(self.id2fun)
+                            self.id2fun.append(fun)
+                        self.slot_funs[i].append(self.fun2id[fun])
+                        self.slot_langs[i].append(lang)
+                        self.slot_words[i].append(first)
+                starts[i, n], sizes[i, n] = word_slots[i][word]
+        products = sizes.prod(axis=0)
+        return {'counts': np.array(self.counts_by_lang[lang], dtype=np.float64),
+                'starts': starts,
+                'sizes': sizes,
+                'products': products,
+                'chunks': chunk_ngrams(products)}
+
+    def intern_lang_funs(self):
+        """Gives every (lang, fun) pair of a position an id, slot_lang_funs maps the slots to them"""
+        for i in range(self.positions):
+            lang_funs = self.slot_langs[i] * len(self.id2fun) + self.slot_funs[i]
+            _, self.slot_lang_funs[i] = np.unique(lang_funs, return_inverse=True)
+
+    def index_slots(self):
+        """Sorts the slots of each position by word and fun, so that the slot of a fun of a word is found by binary
+        search in slot_keys and slot_key_ids maps it back"""
+        for i in range(self.positions):
+            keys = self.slot_words[i] * self.radix + self.slot_funs[i]
+            self.slot_key_ids[i] = np.argsort(keys, kind='stable')
+            self.slot_keys[i] = keys[self.slot_key_ids[i]]
+
+    def intern_fun_ngrams(self):
+        """
+        Gives every fun ngram that is a candidate of some ngram an id, in the order they are first seen, going through
+        the candidates a chunk at a time. fun_ngram_codes maps the ids to the codes of the fun ngrams.
+        """
+        codes_by_chunk = list()
+        seen = np.zeros([0], dtype=np.int64)
+        for slots in self.slots_by_lang:
+            for ngrams in slots['chunks']:
+                _, _, codes = self.product_candidates(slots, ngrams)
+                unique, first = np.unique(codes, return_index=True)
+                new = ~np.isin(unique, seen, assume_unique=True)
+                codes_by_chunk.append(codes[np.sort(first[new])])
+                seen = np.union1d(seen, unique[new])
+        self.fun_ngram_codes = np.concatenate(codes_by_chunk)
+
+    @property
+    def id2fun_ngram(self):
+        funs = [self.fun_ngram_codes // self.radix ** (self.positions - 1 - i) % self.radix
+                for i in range(self.positions)]
+        return [tuple(self.id2fun[fun] for fun in fun_ngram) for fun_ngram in zip(*funs)]
+
+    def fun_ngram_probs(self):
+        return zip(self.id2fun_ngram, self.fun_ngram_counts)
+
+    def index_fun_ngrams(self):
+        """
+        Indexes the fun ngrams with a nonzero count by their first fun: index_codes holds their codes in order, so
+        the ones starting with fun f are index_offsets[f]:index_offsets[f + 1], and index_ids their ids.
+        slot_index_offsets sums the sizes of these ranges over the slots of the first position, so that
+        chunk_candidates can tell how many indexed fun ngrams start with a possibility of a word. A count that is zero
+        (see the prune argument of EM) stays zero in all later iterations, so the index only shrinks.
+        """
+        ids = np.flatnonzero(self.fun_ngram_counts > 0)
+        codes = self.fun_ngram_codes[ids]
+        order = np.argsort(codes, kind='stable')
+        self.index_ids = ids[order]
+        self.index_codes = codes[order]
+        self.index_offsets = np.searchsorted(self.index_codes // self.radix ** (self.positions - 1),
+                                             np.arange(self.radix + 1))
+        slot_sizes = np.diff(self.index_offsets)[self.slot_funs[0]]
+        self.slot_index_offsets = np.zeros([slot_sizes.size + 1], dtype=np.int64)
+        np.cumsum(slot_sizes, out=self.slot_index_offsets[1:])
+
+    def product_candidates(self, slots, ngrams):
+        """
+        Expands the candidates of ngrams from the product of the possibilities of their words, one position at a time.
+        :return: the candidates' number in ngrams, their slots by position and their fun ngram codes
+        """
+        ngram_ids = np.arange(ngrams.size)
+        slot_ids = list()
+        codes = np.zeros([ngrams.size], dtype=np.int64)
+        for i in range(self.positions):
+            owners, position_slot_ids = expand_ranges(slots['starts'][i, ngrams[ngram_ids]],
+                                                      slots['sizes'][i, ngrams[ngram_ids]])
+            ngram_ids = ngram_ids[owners]
+            slot_ids = [ids[owners] for ids in slot_ids] + [position_slot_ids]
+            codes = codes[owners] * self.radix + self.slot_funs[i][position_slot_ids]
+        return ngram_ids, slot_ids, codes
+
+    def indexed_candidates(self, slots, ngrams):
+        """
+        Generates the candidates of ngrams that have a nonzero fun ngram count from the index: for each possibility
+        of the first word, the indexed fun ngrams starting with it whose other funs are possibilities of the other
+        words.
+        :return: the candidates' number in ngrams, their slots by position and their fun ngram ids
+        """
+        pairs, first_slots = expand_ranges(slots['starts'][0, ngrams], slots['sizes'][0, ngrams])
+        funs = self.slot_funs[0][first_slots]
+        owners, rows = expand_ranges(self.index_offsets[funs], np.diff(self.index_offsets)[funs])
+        ngram_ids = pairs[owners]
+        slot_ids = [first_slots[owners]]
+        found = np.ones([rows.size], dtype=bool)
+        for i in range(1, self.positions):
+            funs = self.index_codes[rows] // self.radix ** (self.positions - 1 - i) % self.radix
+            keys = slots['starts'][i, ngrams[ngram_ids]] * self.radix + funs
+            where = np.minimum(np.searchsorted(self.slot_keys[i], keys), self.slot_keys[i].size - 1)
+            found &= self.slot_keys[i][where] == keys
+            slot_ids.append(self.slot_key_ids[i][where])
+        return ngram_ids[found], [ids[found] for ids in slot_ids], self.index_ids[rows[found]]
+
+    def lookup_fun_ngrams(self, codes):
+        """returns the ids of the fun ngrams with codes in the index, and which are in it"""
+        if self.index_codes.size == 0:
+            return np.zeros([codes.size], dtype=np.int64), np.zeros([codes.size], dtype=bool)
+        where = np.minimum(np.searchsorted(self.index_codes, codes), self.index_codes.size - 1)
+        return self.index_ids[where], self.index_codes[where] == codes
+
+    def run(self, callback=None):
+        """Runs EM until convergence, callback is called with a dict of statistics after each iteration and at the end,
+        see em_log.EMLog"""
         iterations = 0
         convergence_diff = 0
+        start = time.time()
         while iterations < 2 or convergence_diff >= self.convergence_threshold:
-            convergence_diff = self.do_em_iteration()
+            convergence_diff = self.do_em_iteration(callback, iterations + 1)
             iterations = iterations + 1
-
-    def do_em_iteration(self):
+        if callback:
+            callback({'event': 'done',
+                      'iterations': iterations,
+                      'convergence_diff': float(convergence_diff),
+                      'seconds': time.time() - start})
+        return iterations
+
+    def do_em_iteration(self, callback=None, iteration=None):
         self.init_new_counters()
+        languages = []
+        e_start = time.time()
         for s in range(self.langs):
-            for count, ngram in zip(self.counts_by_lang[s], self.ngrams_by_lang[s]):
-                self.update_counts(s, count, ngram)
+            lang_start = time.time()
+            expected_count = self.update_counts(s)
+            languages.append({'language': s,
+                              'e_step_seconds': time.time() - lang_start,
+                              'expected_count': expected_count})
+        m_start = time.time()
+        if self.prune:
+            self.new_fun_ngram_counts[self.new_fun_ngram_counts < self.prune] = 0
+        self.update_fun_by_lang_and_position()
         convergence_diff = self.get_convergence_diff()
         self.save_counters()
+        if np.count_nonzero(self.fun_ngram_counts) < self.index_ids.size * COMPACT_FRACTION:
+            self.index_fun_ngrams()
+        if callback:
+            callback({'event': 'iteration',
+                      'iteration': iteration,
+                      # the first iteration is compared with the initial counts, which are not estimates
+                      'convergence_diff': None if iteration == 1 else float(convergence_diff),
+                      'e_step_seconds': m_start - e_start,
+                      'm_step_seconds': time.time() - m_start,
+                      'languages': languages})
         return convergence_diff
 
-    def update_counts(self, lang, count, ngram):
-        fun_ngrams = list(self.possible_fun_ngrams(lang, ngram))
-        joint_probs = [self.get_fun_ngram_count(fun_ngram) * self.get_ngram_conditional(ngram, fun_ngram, lang) for
-                       fun_ngram in fun_ngrams]
-        total_prob = sum(joint_probs)
-        fun_ngram_probs = [prob / total_prob for prob in
-                           joint_probs]  # =P(Y|X) = \phi_{si.}*\pi / (\sum_k \phi_{sik}*\pi_k
-        for i, fun_ngram in enumerate(fun_ngrams):
-            expected_count = count * fun_ngram_probs[i]
-            self.update_fun_ngram_counts(fun_ngram, expected_count)
-            self.update_word_conditionals(lang, ngram, fun_ngram, expected_count)
-
-    def possible_fun_ngrams(self, lang, ngram):
-        return product(*[poss_dict[word] for word, poss_dict in zip(ngram,self.poss_dict_by_lang_and_ngram_position[lang])])
-
-    def get_fun_ngram_count(self, fun_ngram):
-        return self.fun_ngram_counts[fun_ngram]
-
-    def get_ngram_conditional(self, ngram,fun_ngram,lang):
-        probability = 1
-        for ngram_position, fun in enumerate(fun_ngram):
-            word = ngram[ngram_position]
-            probability = probability*self.word_conditionals[lang][ngram_position][word][fun]\
-                          /self.fun_by_lang_and_position[lang][ngram_position][fun]
-        return probability
-
-    def update_fun_ngram_counts(self, fun_ngram, expected_count):
-        self.new_fun_ngram_counts[fun_ngram] = self.new_fun_ngram_counts[fun_ngram] + expected_count
-
-    def update_word_conditionals(self, lang, ngram, fun_ngram, expected_count):
-        for ngram_position, fun in enumerate(fun_ngram):
-            word = ngram[ngram_position]
-            self.new_word_conditionals[lang][ngram_position][word][fun] = \
-                    self.new_word_conditionals[lang][ngram_position][word][fun] + expected_count
-
-            self.new_fun_by_lang_and_position[lang][ngram_position][fun] = \
-                    self.new_fun_by_lang_and_position[lang][ngram_position][fun] + expected_count
-
+    def chunk_candidates(self, slots, ngrams):
+        """
+        Generates the candidates of a chunk of ngrams with a nonzero fun ngram count. The candidates of an ngram come
+        from the product of its possibilities or from the index of the nonzero fun ngram counts, whichever is smaller,
+        so the work follows the number of nonzero parameters rather than the product once counts reach zero.
+        :return: the candidates' number in the chunk, their slots by position and their fun ngram ids
+        """
+        starts, sizes = slots['starts'][0, ngrams], slots['sizes'][0, ngrams]
+        by_index = self.slot_index_offsets[starts + sizes] - self.slot_index_offsets[starts] < slots['products'][ngrams]
+        ngram_ids, slot_ids, fun_ngram_ids = self.indexed_candidates(slots, ngrams[by_index])
+        expanded = np.flatnonzero(~by_index)
+        product_ngram_ids, product_slot_ids, codes = self.product_candidates(slots, ngrams[expanded])
+        product_fun_ngram_ids, found = self.lookup_fun_ngrams(codes)
+        return (np.concatenate([np.flatnonzero(by_index)[ngram_ids], expanded[product_ngram_ids[found]]]),
+                [np.concatenate([ids, product_ids[found]]) for ids, product_ids in zip(slot_ids, product_slot_ids)],
+                np.concatenate([fun_ngram_ids, product_fun_ngram_ids[found]]))
+
+    def update_counts(self, lang):
+        """
+        Adds the expected counts of the candidates of lang, a chunk of ngrams at a time. The candidates of the first
+        chunks are kept for the next iterations, up to CACHE_SIZE of them, the others are generated again by
+        chunk_candidates, so the memory is bounded by the chunk and cache sizes and not by the number of candidates.
+        :return: the expected count of lang, the count of its ngrams that some candidate has a probability for
+        """
+        slots = self.slots_by_lang[lang]
+        expected_count = 0.0
+        for c, ngrams in enumerate(slots['chunks']):
+            if (lang, c) in self.cache:
+                ngram_ids, slot_ids, fun_ngram_ids = self.cache[lang, c]
+            else:
+                ngram_ids, slot_ids, fun_ngram_ids = self.chunk_candidates(slots, ngrams)
+                if self.cached + ngram_ids.size <= CACHE_SIZE:
+                    self.cache[lang, c] = (ngram_ids, slot_ids, fun_ngram_ids)
+                    self.cached += ngram_ids.size
+            joint_probs = self.fun_ngram_counts[fun_ngram_ids]
+            for i in range(self.positions):
+                joint_probs *= self.slot_conditionals[i][slot_ids[i]]
+            # the kept candidates with a zero parameter have probability zero, so they are only looked for if enough
+            # have it
+            if (lang, c) in self.cache and np.count_nonzero(joint_probs) < joint_probs.size * COMPACT_FRACTION:
+                alive = self.fun_ngram_counts[fun_ngram_ids] > 0
+                for i in range(self.positions):
+                    alive &= self.slot_conditionals[i][slot_ids[i]] > 0
+                if np.count_nonzero(alive) < alive.size * COMPACT_FRACTION:
+                    ngram_ids, slot_ids, fun_ngram_ids = self.compact_candidates((lang, c), alive)
+                    joint_probs = joint_probs[alive]
+            total_probs = np.bincount(ngram_ids, weights=joint_probs, minlength=ngrams.size)
+            # =P(Y|X) = \phi_{si.}*\pi / (\sum_k \phi_{sik}*\pi_k times the count of the ngram
+            joint_probs *= (slots['counts'][ngrams] / np.where(total_probs > 0, total_probs, 1))[ngram_ids]
+            expected_count += float(np.sum(joint_probs))
+            self.new_fun_ngram_counts += np.bincount(fun_ngram_ids, weights=joint_probs,
+                                                     minlength=self.new_fun_ngram_counts.size)
+            for i in range(self.positions):
+                self.new_word_conditionals[i] += np.bincount(slot_ids[i], weights=joint_probs,
+                                                             minlength=self.new_word_conditionals[i].size)
+        return expected_count
+
+    def compact_candidates(self, key, alive):
+        """
+        Keeps only the candidates of the chunk key where alive is set. A fun ngram count or word conditional that is
+        zero stays zero in all later iterations, so the candidates using one never get a probability again.
+        """
+        ngram_ids, slot_ids, fun_ngram_ids = self.cache[key]
+        self.cache[key] = (ngram_ids[alive], [ids[alive] for ids in slot_ids], fun_ngram_ids[alive])
+        self.cached -= alive.size - np.count_nonzero(alive)
+        return self.cache[key]
+
+    def update_fun_by_lang_and_position(self):
+        for i in range(self.positions):
+            self.new_fun_by_lang_and_position[i][:] = np.bincount(
+                self.slot_lang_funs[i], weights=self.new_word_conditionals[i],
+                minlength=self.new_fun_by_lang_and_position[i].size)
 
     def init_counters(self):
-        self.word_conditionals = [[defaultdict(lambda : defaultdict(lambda : 1))
-                                       for _ in range(self.positions)]
-                                      for _ in range(self.langs)]
-        self.fun_by_lang_and_position = [[defaultdict(lambda : 1)
-                                          for _ in range(self.positions)]
-                                         for _ in range(self.langs)]
-        self.fun_ngram_counts = defaultdict(lambda : 1)
-
+        """
+        Allocates the counts once: the fun ngram counts, the word conditionals (the expected count of each slot) and
+        the fun counts by lang and position (the sum over the slots of each (lang, fun) pair of a position). The new_
+        arrays are reset in place each iteration and swapped with the current ones by save_counters.
+        """
+        self.fun_ngram_counts = np.ones([self.fun_ngram_codes.size])
+        self.word_conditionals = [np.ones([len(funs)]) for funs in self.slot_funs]
+        self.fun_by_lang_and_position = [np.ones([lang_funs.max(initial=-1) + 1])
+                                         for lang_funs in self.slot_lang_funs]
+        self.slot_conditionals = [np.ones([len(funs)]) for funs in self.slot_funs]
+        self.new_fun_ngram_counts = np.zeros_like(self.fun_ngram_counts)
+        self.new_word_conditionals = [np.zeros_like(counts) for counts in self.word_conditionals]
+        self.new_fun_by_lang_and_position = [np.zeros_like(counts) for counts in self.fun_by_lang_and_position]
 
     def init_new_counters(self):
-        self.new_word_conditionals = [[defaultdict(lambda: defaultdict(lambda: 0))
-                                   for _ in range(self.positions)]
-                                  for _ in range(self.langs)]
-        self.new_fun_by_lang_and_position = [[defaultdict(lambda: 0)
-                                          for _ in range(self.positions)]
-                                         for _ in range(self.langs)]
-        self.new_fun_ngram_counts = defaultdict(lambda: 0)
-
+        for i in range(self.positions):
+            fun_counts = self.fun_by_lang_and_position[i][self.slot_lang_funs[i]]
+            # a (lang, fun) pair whose slots are all zero (after pruning) gives zero and not nan
+            self.slot_conditionals[i].fill(0)
+            np.divide(self.word_conditionals[i], fun_counts, out=self.slot_conditionals[i], where=fun_counts > 0)
+            self.new_word_conditionals[i].fill(0)
+        self.new_fun_ngram_counts.fill(0)
 
     def save_counters(self):
-        self.word_conditionals = self.new_word_conditionals
-        self.fun_by_lang_and_position = self.new_fun_by_lang_and_position
-        self.fun_ngram_counts = self.new_fun_ngram_counts
-
+        self.word_conditionals, self.new_word_conditionals = self.new_word_conditionals, self.word_conditionals
+        self.fun_by_lang_and_position, self.new_fun_by_lang_and_position = \
+            self.new_fun_by_lang_and_position, self.fun_by_lang_and_position
+        self.fun_ngram_counts, self.new_fun_ngram_counts = self.new_fun_ngram_counts, self.fun_ngram_counts
 
     def get_convergence_diff(self):
-        return sum(self.new_fun_ngram_counts[fun]*log(self.new_fun_ngram_counts[fun]/self.fun_ngram_counts[fun])
-                   for fun in self.new_fun_ngram_counts.keys()
-                   if self.fun_ngram_counts[fun]>1e-10 and self.new_fun_ngram_counts[fun]>1e-10)/self.total_counts
+        mask = (self.fun_ngram_counts > 1e-10) & (self.new_fun_ngram_counts > 1e-10)
+        new_counts = self.new_fun_ngram_counts[mask]
+        return np.sum(new_counts * np.log(new_counts / self.fun_ngram_counts[mask])) / self.total_counts
 
 
 class EMPossibility:
@@ -146,6 +402,12 @@ if __name__ == '__main__':
                         help='Ngram order',
                         default=2)
     parser.add_argument('-f', type=int, help='Number of features', default=2)
+    parser.add_argument('--factored', action='store_true',
+                        help='The input is in the factored format of make_em_data.py --factored')
+    parser.add_argument('--log', type=str, help='Append statistics for each iteration as JSON lines to this file')
+    parser.add_argument('--prune', type=float, default=0.0,
+                        help='Set fun ngram counts below this to zero after each iteration, so that the candidates '
+                             'using them are dropped (default: no pruning)')
     args = parser.parse_args()
 
     if args.d:
@@ -158,17 +420,9 @@ if __name__ == '__main__':
         poss_dicts_by_lang_and_pos = list()
         for s, lang in enumerate(langs):
             poss_dicts_by_pos = {pos : dict() for pos in parts_of_speech}
-            with open(pd_path+"/"+lang+".txt", mode='r', encoding="utf-8") as file:
-                for line in file:
-                    l_split = line.strip('\n').split('\t')
-                    word = l_split[0]
-                    pos = l_split[1]
-                    funs = l_split[2:]
-                    if pos in parts_of_speech:
-                        if word in poss_dicts_by_pos[pos].keys():
-                            poss_dicts_by_pos[pos][word] = list(set(poss_dicts_by_pos[pos][word]+funs))
-                        else:
-                            poss_dicts_by_pos[pos][word]=funs
+            for (word, pos), funs in load_poss_dict(pd_path+"/"+lang+".txt").items():
+                if pos in parts_of_speech:
+                    poss_dicts_by_pos[pos][word] = funs
             poss_dicts_by_lang_and_pos.append(poss_dicts_by_pos)
         poss_dicts_by_lang_and_position = \
             [[poss_dicts_by_lang_and_pos[lang][pos] for pos in position2pos] for lang in range(len(langs))]
@@ -186,7 +440,9 @@ if __name__ == '__main__':
     counts = []
     current_lang = 0
     em_data_poss_dicts_by_lang_and_position = []
-    poss_dicts = [defaultdict(list) for _ in range(args.o)]
+    # words are interned to ints so that each word is stored once and not once per ngram
+    word2id = dict()
+    poss_dicts = [dict() for _ in range(args.o)]
     for l in sys.stdin:
         if l.strip('\n') == '---': #new language
             current_lang = current_lang + 1
@@ -195,26 +451,38 @@ if __name__ == '__main__':
             em_data_poss_dicts_by_lang_and_position.append(poss_dicts)
             ngrams = []
             counts = []
-            poss_dicts = [defaultdict(list) for _ in range(args.o)]
+            poss_dicts = [dict() for _ in range(args.o)]
         else:
             l_split = l.strip('\n').split('\t')
             counts.append(int(l_split[0]))
             words = []
             for i in range(1,1+args.o*args.f,args.o):
-                words.append(tuple(l_split[i:i+args.o]))
-            for i in range(args.o):
-                for j in range(1+args.o * args.f+i, len(l_split), args.o):
-                    fun = l_split[j]
-                    if fun not in poss_dicts[i][words[i]]:
-                        poss_dicts[i][words[i]].append(fun)
+                words.append(word2id.setdefault(tuple(l_split[i:i+args.o]), len(word2id)))
+            if args.factored:
+                # the possibilities of each position are given once, as their number followed by the possibilities
+                start = 1+args.o * args.f
+                for i in range(args.o):
+                    n = int(l_split[start])
+                    funs = poss_dicts[i].setdefault(words[i], [])
+                    for fun in l_split[start+1:start+1+n]:
+                        if fun not in funs:
+                            funs.append(fun)
+                    start = start + 1 + n
+            else:
+                for i in range(args.o):
+                    funs = poss_dicts[i].setdefault(words[i], [])
+                    for j in range(1+args.o * args.f+i, len(l_split), args.o):
+                        fun = l_split[j]
+                        if fun not in funs:
+                            funs.append(fun)
             ngrams.append(tuple(words))
 
     n_grams_by_lang.append(ngrams)
     counts_by_lang.append(counts)
     em_data_poss_dicts_by_lang_and_position.append(poss_dicts)
-    em = EM(em_data_poss_dicts_by_lang_and_position, counts_by_lang, n_grams_by_lang)
-    em.run()
-    em_probs = em.fun_ngram_counts
-    for fun, probability in em_probs.items():
+    em = EM(em_data_poss_dicts_by_lang_and_position, counts_by_lang, n_grams_by_lang, prune=args.prune)
+    with EMLog(args.log) as em_log:
+        em.run(callback=em_log if args.log else None)
+    for fun, probability in em.fun_ngram_probs():
         print(*([probability] + list(fun)), sep='\t')
 
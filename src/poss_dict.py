@@ -0,0 +1,164 @@
+from array import array
+import numpy as np
+import os
+
+
+class PossDict:
+    """
+    A possibility dictionary, mapping words to the list of functions they can represent, stored compactly: the
+    function names are interned in a string table and the possibilities of entry i are
+    id2fun[funs[offsets[i]:offsets[i+1]]]. Words with more than one line in the dictionary get the union of their
+    possibilities, in the order they are first seen. Looking up a missing word gives an empty list.
+    """
+    def __init__(self, keys, id2fun, offsets, funs, make_key=None):
+        self.id2fun = id2fun
+        self.offsets = offsets
+        self.funs = funs
+        self.index = dict()
+        # entries of words that make_key maps to the same key (e.g. when lower casing) are merged here
+        self.merged = dict()
+        for i, columns in enumerate(keys):
+            key = make_key(*columns) if make_key else columns
+            if key in self.index:
+                fun_ids = self.merged.get(key, self._fun_ids(self.index[key]))
+                self.merged[key] = fun_ids + [fun for fun in self._fun_ids(i) if fun not in fun_ids]
+            else:
+                self.index[key] = i
+
+    def _fun_ids(self, i):
+        return self.funs[self.offsets[i]:self.offsets[i+1]].tolist()
+
+    def __getitem__(self, key):
+        if key in self.merged:
+            return [self.id2fun[fun] for fun in self.merged[key]]
+        i = self.index.get(key)
+        if i is None:
+            return []
+        return [self.id2fun[fun] for fun in self._fun_ids(i)]
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+    def keys(self):
+        return self.index.keys()
+
+    def items(self):
+        return ((key, self[key]) for key in self.index)
+
+    def reverse(self):
+        """Returns a dict from each function to the list of keys that can represent it"""
+        out = dict()
+        for key, funs in self.items():
+            for fun in funs:
+                if fun in out:
+                    out[fun].append(key)
+                else:
+                    out[fun] = [key]
+        return out
+
+
+def parse_poss_dict(path, key_columns=2):
+    """
+    Parses a possibility dictionary in tsv format, key_columns columns with the word followed by one column per
+    function, e.g. columnist <tab> NOUN <tab> columnistFem_N <tab> columnistMasc_N. The possibilities of repeated
+    words are merged with one np.unique over all (entry, function) pairs instead of merging lists.
+    :return: keys (list of column tuples), id2fun, offsets and funs as in PossDict
+    """
+    key2id = dict()
+    fun2id = dict()
+    entries = array('q')
+    funs = array('q')
+    with open(path, mode='r', encoding='utf-8') as file:
+        for l in file:
+            l_split = l.strip('\n').split('\t')
+            if len(l_split) < key_columns:
+                continue
+            entry = key2id.setdefault(tuple(l_split[:key_columns]), len(key2id))
+            for fun in l_split[key_columns:]:
+                if fun:
+                    entries.append(entry)
+                    funs.append(fun2id.setdefault(fun, len(fun2id)))
+    entries = np.frombuffer(entries, dtype=np.int64)
+    funs = np.frombuffer(funs, dtype=np.int64)
+    # keep the first occurrence of every (entry, function) pair, grouped by entry in the order of the file
+    _, first = np.unique(entries * max(len(fun2id), 1) + funs, return_index=True)
+    first.sort()
+    first = first[np.argsort(entries[first], kind='stable')]
+    offsets = np.zeros([len(key2id) + 1], dtype=np.int64)
+    np.cumsum(np.bincount(entries[first], minlength=len(key2id)), out=offsets[1:])
+    return list(key2id.keys()), list(fun2id.keys()), offsets, funs[first].astype(np.int32)
+
+
+def cache_path(path, key_columns):
+    return '{}.{}.cache.npz'.format(path, key_columns)
+
+
+def _encode(strings):
+    return np.frombuffer('\n'.join(strings).encode('utf-8'), dtype=np.uint8)
+
+
+def _decode(data):
+    return data.tobytes().decode('utf-8').split('\n')
+
+
+def read_cache(path, key_columns, stat):
+    """Returns the parsed dictionary from the cache next to path, or None if it is missing or older than the file"""
+    try:
+        with np.load(cache_path(path, key_columns)) as cache:
+            if cache['mtime_ns'] != stat.st_mtime_ns or cache['size'] != stat.st_size:
+                return None
+            keys = _decode(cache['keys'])
+            key_columns = int(cache['key_columns'])
+            if not cache['n_keys']:
+                keys = []
+            keys = [tuple(keys[i:i+key_columns]) for i in range(0, len(keys), key_columns)]
+            id2fun = _decode(cache['id2fun']) if cache['n_funs'] else []
+            return keys, id2fun, cache['offsets'], cache['funs']
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def write_cache(path, key_columns, stat, keys, id2fun, offsets, funs):
+    """Writes the cache next to path, nothing is done if that is not possible (e.g. a read only directory)"""
+    # the process id keeps processes that parse the same dictionary at the same time from writing the same file
+    tmp_path = '{}.{}.tmp'.format(cache_path(path, key_columns), os.getpid())
+    try:
+        with open(tmp_path, mode='wb') as file:
+            np.savez(file, mtime_ns=stat.st_mtime_ns, size=stat.st_size, key_columns=key_columns,
+                     n_keys=len(keys), n_funs=len(id2fun),
+                     keys=_encode(column for key in keys for column in key), id2fun=_encode(id2fun),
+                     offsets=offsets, funs=funs)
+        os.replace(tmp_path, cache_path(path, key_columns))
+    except OSError:
+        pass
+
+
+# loaded dictionaries by (path, key_columns, make_key, mtime and size), shared by all callers in a process
+_loaded = dict()
+
+
+def load_poss_dict(path, key_columns=2, make_key=None):
+    """
+    Loads the possibility dictionary at path as a PossDict. The parsed dictionary is cached on disk in a binary form
+    next to the file (see cache_path) and reparsed when the file's modification time or size changes, and every
+    dictionary is loaded only once per process.
+    :param path: path to the tsv dictionary
+    :param key_columns: number of columns with the word
+    :param make_key: called with the word columns to make the key of each word, e.g. to lower case them, the keys are
+     tuples of the columns if it is not given
+    """
+    stat = os.stat(path)
+    memo_key = (os.path.abspath(path), key_columns, make_key, stat.st_mtime_ns, stat.st_size)
+    if memo_key not in _loaded:
+        parsed = read_cache(path, key_columns, stat)
+        if parsed is None:
+            parsed = parse_poss_dict(path, key_columns)
+            write_cache(path, key_columns, stat, *parsed)
+        _loaded[memo_key] = PossDict(*parsed, make_key=make_key)
+    return _loaded[memo_key]
@@ -0,0 +1,161 @@
+from multiprocessing import Pool
+from glob import glob
+import argparse
+import gzip
+import time
+import shutil
+import sys
+import os
+import numpy as np
+from em_log import EMLog
+from wn_em import read_em_data, read_em_binary, em_algorithm_flat, format_probs, Checkpoint, read_cnt, \
+    warm_start_probs
+PYTHONIOENCODING="UTF-8"
+
+
+def read_splits(directory):
+    """Sums the counts of each split over the 1_splits.txt files of all languages in directory"""
+    split_counts = dict()
+    for path in sorted(glob(os.path.join(directory, '*', '1_splits.txt'))):
+        with open(path, mode='r', encoding='utf-8') as file:
+            for l in file:
+                l_split = l.strip('\n').split('\t')
+                split_counts[l_split[1]] = split_counts.get(l_split[1], 0) + int(l_split[0])
+    return split_counts
+
+
+def split_lines(directory, split):
+    """Yields the lines of the gzipped data files for split in all languages in directory, in language order"""
+    for path in sorted(glob(os.path.join(directory, '*', split + '.txt.gz'))):
+        with gzip.open(path, mode='rt', encoding='utf-8') as file:
+            yield from file
+
+
+def binary_prefixes(directory, split):
+    """Returns the path prefixes of the binary data files for split in all languages in directory, in language order"""
+    suffix = '.counts.npy'
+    return [path[:-len(suffix)] for path in sorted(glob(os.path.join(directory, '*', split + suffix)))]
+
+
+# probabilities of an earlier run by deprel (see wn_em.read_cnt) used to initialize the splits, set in each worker
+warm_start = None
+
+
+def init_worker(warm_start_probs_by_deprel):
+    global warm_start
+    warm_start = warm_start_probs_by_deprel
+
+
+def run_split(task):
+    """
+    Runs EM for one split and returns the split, the output lines, the wall time and the iteration statistics (see
+    em_log.EMLog). The binary format from make_em_data.py -b is used if it exists, otherwise the gzipped tsv files,
+    which are read in the format of make_em_data.py --factored if factored is set.
+    If checkpoint_dir is given the EM state is saved there every checkpoint_every iterations and the output of the
+    split when it is done, and a rerun continues from there.
+    """
+    directory, split, features, poss_columns, factored, threshold, checkpoint_dir, checkpoint_every = task
+    start = time.time()
+    deprel = split.split('_')[1] if '_' in split else ''
+    if checkpoint_dir and os.path.isfile(os.path.join(checkpoint_dir, split + '.cnt')):
+        with open(os.path.join(checkpoint_dir, split + '.cnt'), mode='r', encoding='utf-8') as file:
+            return split, file.read().splitlines(), time.time() - start, list()
+
+    prefixes = binary_prefixes(directory, split)
+    if prefixes:
+        languages, unambiguous_counts, id2fun = read_em_binary(prefixes)
+    else:
+        languages, unambiguous_counts, id2fun = read_em_data(split_lines(directory, split), features, poss_columns,
+                                                             factored)
+    if warm_start is not None:
+        init_probs = warm_start_probs(warm_start.get(deprel, dict()), id2fun)
+    else:
+        init_probs = np.ones([len(id2fun)])
+    first_iteration = 1
+    checkpoint = None
+    if checkpoint_dir:
+        checkpoint = Checkpoint(os.path.join(checkpoint_dir, split + '.npz'), id2fun, checkpoint_every)
+        state = checkpoint.load(languages)
+        if state:
+            iteration, init_probs = state
+            first_iteration = iteration + 1
+    records = list()
+    em_probs = em_algorithm_flat(languages,
+                                 init_probs,
+                                 unambiguous_counts,
+                                 convergence_threshold=1e-5,
+                                 callback=records.append,
+                                 checkpoint=checkpoint,
+                                 first_iteration=first_iteration)
+    lines = list(format_probs(em_probs, id2fun, threshold=threshold, extra=[deprel]))
+    if checkpoint:
+        path = os.path.join(checkpoint_dir, split + '.cnt')
+        with open(path + '.tmp', mode='w', encoding='utf-8') as file:
+            file.write(''.join(line + '\n' for line in lines))
+        os.replace(path + '.tmp', path)
+        checkpoint.remove()
+    return split, lines, time.time() - start, records
+
+
+def run_em(directory, out_file, features=4, poss_columns=2, threshold=0.0001, jobs=1, log=None,
+           warm_start_file=None, checkpoint_dir=None, checkpoint_every=10, factored=False):
+    """
+    Runs EM on every split found in the language directories of directory, largest split first, and writes the
+    thresholded probabilities with the deprel of the split appended to out_file. Nothing is done if out_file exists.
+    The iteration statistics of each split are passed to log (an em_log.EMLog or other callable) with the split added.
+    The splits are initialized from the rows with the same deprel in warm_start_file (the output of an earlier run)
+    if it is given. With checkpoint_dir an interrupted run is continued where it stopped, the directory is removed
+    when out_file is written.
+    """
+    if os.path.isfile(out_file):
+        return
+    split_counts = read_splits(directory)
+    splits = sorted(split_counts.keys(), key=lambda split: (-split_counts[split], split))
+    tasks = [(directory, split, features, poss_columns, factored, threshold, checkpoint_dir, checkpoint_every)
+             for split in splits]
+    warm_start_probs_by_deprel = read_cnt(warm_start_file, poss_columns) if warm_start_file else None
+    if checkpoint_dir:
+        os.makedirs(checkpoint_dir, exist_ok=True)
+    start = time.time()
+    # write to a temporary file so that an interrupted run is not taken as finished by the existence check
+    with open(out_file + '.tmp', mode='w', encoding='utf-8') as out, \
+            Pool(jobs, initializer=init_worker, initargs=(warm_start_probs_by_deprel,)) as pool:
+        # imap gives the results in the order of the splits so the output is the same as for a serial run
+        for split, lines, seconds, records in pool.imap(run_split, tasks):
+            print(split, '{:.2f}s'.format(seconds), sep='\t', file=sys.stderr)
+            if log:
+                for record in records:
+                    log(dict(record, split=split))
+            if lines:
+                out.write('\n'.join(lines) + '\n')
+    os.replace(out_file + '.tmp', out_file)
+    if checkpoint_dir:
+        shutil.rmtree(checkpoint_dir)
+    print('{} splits in {:.2f}s'.format(len(splits), time.time() - start), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="""
+    Runs wn_em.py on all splits of the em data in a directory with one sub directory per language (as written by
+    make_em_data.py and gzipped by make_all_em_data.sh, or in the binary format of make_em_data.py -b). The splits
+    are scheduled largest first on a pool of processes and the probabilities above the threshold are written with the
+    deprel of the split as last column.
+    """)
+    parser.add_argument('directory', type=str, help='EM data directory with one directory per language')
+    parser.add_argument('out', type=str, help='Output file, nothing is done if it exists')
+    parser.add_argument('-f', type=int, help='Number of feature columns.', default=4)
+    parser.add_argument('-p', type=int, help='Number of columns per possibility', default=2)
+    parser.add_argument('--factored', action='store_true',
+                        help='The tsv files are in the factored format of make_em_data.py --factored')
+    parser.add_argument('-t', type=float, help='Only write probabilities above this threshold', default=0.0001)
+    parser.add_argument('-j', type=int, help='Number of splits run in parallel', default=os.cpu_count())
+    parser.add_argument('--log', type=str, help='Append statistics for each split and iteration as JSON lines to this file')
+    parser.add_argument('--warm-start', type=str,
+                        help='Initialize each split from the rows with its deprel in the output of an earlier run')
+    parser.add_argument('--checkpoint', type=str,
+                        help='Directory for checkpoints, an interrupted run with the same directory continues from it')
+    parser.add_argument('--checkpoint-every', type=int, help='Iterations between checkpoints', default=10)
+    args = parser.parse_args()
+    with EMLog(args.log) as log:
+        run_em(args.directory, args.out, args.f, args.p, args.t, args.j, log if args.log else None,
+               args.warm_start, args.checkpoint, args.checkpoint_every, args.factored)
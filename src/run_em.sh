@@ -3,20 +3,11 @@
 PYTHONIOENCODING="UTF-8"
 
 unigram_opts="-f2 -p1"
+jobs=$(nproc)
+factored="" # "--factored" if the em data was made with it, see make_all_em_data.sh
 
 run_em () {
-if [ ! -f $2 ]; then
-cat ${1}/*/1_splits.txt | sort -k2 | python merge_counts.py | sort -k1,1nr |
-awk '{print $2}' | while read split
-do
-echo $split>&2
-deprel=$(echo $split | awk -v FS='_' '{print $2}')
-cat ${1}/*/${split}.txt.gz |
-zcat |
-python wn_em.py $3|
-awk -v OFS=$'\t' '$1 > 0.0001 {print $0, var}' var="${deprel}"
-done > $2 
-fi
+python run_em.py -j $jobs $factored $3 $1 $2
 }
 
 combine_probs () {
@@ -28,7 +19,7 @@ fi
 
 recount_no_deprel () {
 if [ ! -f $2 ]; then
-awk -v FS='\t' 'OFS="\t" {if (NF==4) {print $1, $2, $3} else {print $1,$2}}' ../results/$1 | sort -T tmp_sort_file -k2 | python merge_counts.py -f > $2
+awk -v FS='\t' 'OFS="\t" {if (NF==4) {print $1, $2, $3} else {print $1,$2}}' ../results/$1 | python merge_counts.py -f -u -T tmp_sort_file > $2
 fi
 }
 
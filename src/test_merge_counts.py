@@ -0,0 +1,36 @@
+import random
+import unittest
+from merge_counts import Aggregator, aggregate, parse_fields
+
+
+class TestAggregator(unittest.TestCase):
+    def rows(self):
+        random.seed(0)
+        return [[str(random.randint(1, 5)), 'w%d' % random.randint(0, 300), 'h%d' % random.randint(0, 20)]
+                for _ in range(2000)]
+
+    def expected(self, rows, project):
+        counts = dict()
+        for row in rows:
+            columns = project(row)
+            counts[tuple(columns[1:])] = counts.get(tuple(columns[1:]), 0) + int(columns[0])
+        return sorted(counts.items())
+
+    def test_many_spills(self):
+        """A budget of 0 spills every new feature, more runs than can be open at once"""
+        rows = self.rows()
+        projections = [parse_fields('1-3'), parse_fields('1,2')]
+        aggregators = aggregate(rows, projections, memory=0)
+        for project, aggregator in zip(projections, aggregators):
+            self.assertEqual(list(aggregator), self.expected(rows, project))
+
+    def test_open_runs_are_capped(self):
+        aggregator = Aggregator(memory=0, max_runs=4)
+        for row in self.rows():
+            aggregator.add(tuple(row[1:]), int(row[0]))
+            self.assertLess(len(aggregator.runs), 4)
+        self.assertEqual(list(aggregator), self.expected(self.rows(), lambda row: row))
+
+
+if __name__ == '__main__':
+    unittest.main()
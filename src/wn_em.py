@@ -1,12 +1,80 @@
+from itertools import product
+from array import array
 import numpy as np
 import argparse
+import time
+import os
+import multiprocessing
+from multiprocessing import shared_memory
+from em_log import EMLog
+
+class FlatLanguage:
+    """
+    All ambiguous words of one language flattened into a CSR-style layout. The possibilities of word i are found at
+    positions offsets[i]:offsets[i+1] of fun_ids (the function ids) and phi (the conditional probabilities
+    P(word|function)). word_ids holds the word index of each position so that per word sums can be done with bincount.
+    """
+    def __init__(self, counts, offsets, fun_ids, phi):
+        self.counts = np.asarray(counts, dtype=np.float64)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.fun_ids = np.asarray(fun_ids, dtype=np.int64)
+        self.phi = np.asarray(phi, dtype=np.float64)
+        self.word_ids = np.repeat(np.arange(self.counts.size), np.diff(self.offsets))
+        self.log_likelihood = None
+
+    @classmethod
+    def from_lists(cls, word_counts, word_probs, word_possibilities):
+        """Builds the flat layout from the per word lists used by em_algorithm"""
+        lengths = np.array([len(poss) for poss in word_possibilities], dtype=np.int64)
+        offsets = np.zeros([lengths.size + 1], dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        fun_ids = np.concatenate(word_possibilities) if lengths.size else np.zeros([0])
+        phi = np.concatenate(word_probs) if lengths.size else np.zeros([0])
+        return cls(word_counts, offsets, fun_ids, phi)
+
+    def slice(self, start, end):
+        """Returns the words start:end as a new FlatLanguage, sharing no state with this one"""
+        offsets = self.offsets[start:end+1]
+        positions = slice(offsets[0], offsets[-1])
+        return FlatLanguage(self.counts[start:end], offsets - offsets[0],
+                            self.fun_ids[positions], self.phi[positions].copy())
+
+    def word_probs(self):
+        """Splits phi back into one array per word"""
+        return np.split(self.phi, self.offsets[1:-1]) if self.counts.size else []
+
+    def expectation(self, probs):
+        """
+        E-step for the whole language. Returns the expected counts for every (word, function) position and their sum
+        per function, the log-likelihood of the words (with unnormalized probs) is kept in log_likelihood
+        """
+        if self.counts.size == 0:
+            self.log_likelihood = 0.0
+            return np.zeros([0]), np.zeros([probs.size])
+        joint_probs = self.phi*probs[self.fun_ids] #=P(Y,X) = \phi_{si.}*\pi_.
+        total_probs = np.bincount(self.word_ids, weights=joint_probs, minlength=self.counts.size) #P(X) per word
+        with np.errstate(divide='ignore'):
+            self.log_likelihood = np.sum(self.counts*np.log(total_probs)) # -inf if a word got probability zero
+        # make sure we dont divide by zero, if sum is zero, everything is zero anyway
+        scale = np.divide(self.counts, total_probs, out=np.zeros_like(total_probs), where=total_probs > 0)
+        expected_counts = joint_probs*scale[self.word_ids] #=\hat c_{si.} = c_{si}*P(Y|X)
+        expected_fun_counts = np.bincount(self.fun_ids, weights=expected_counts, minlength=probs.size)
+        return expected_counts, expected_fun_counts
+
+    def maximization(self, expected_counts, expected_fun_counts):
+        """Updates phi = P(word|function) from the expected counts of the last E-step"""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            self.phi = np.nan_to_num(expected_counts/expected_fun_counts[self.fun_ids])
+
 
 def em_algorithm(word_counts,
                  init_counts,
                  unambiguous_counts,
                  word_probs,
                  word_possibilities,
-                 convergence_threshold=1e-5):
+                 convergence_threshold=1e-5,
+                 jobs=1,
+                 callback=None):
     """
     The actual algorithm. It takes counts in the word (observed) domain and uses EM to
     give expected counts in the function (latent) domain. Words belong to one of several languages.
@@ -22,59 +90,551 @@ def em_algorithm(word_counts,
     :param word_probs: list of lists of numpy arrays on the form word_probs[lang][word]
     :param word_possibilities: list of list of numpy arrays on the form word_probs[lang][word]
     :param convergence_threshold: float
+    :param jobs: int, number of processes used for the E- and M-steps
+    :param callback: called with a dict of statistics after each iteration and at the end, see em_log.EMLog
     :return: tuples with the resulting function probabilities and word counts given for each language
     """
-    langs = list(range(len(word_counts)))
+    languages = [FlatLanguage.from_lists(wc, wprob, wp)
+                 for wc, wprob, wp in zip(word_counts, word_probs, word_possibilities)]
+    probs = em_algorithm_flat(languages, init_counts, unambiguous_counts, convergence_threshold, jobs, callback)
+    return probs, [language.word_probs() for language in languages]
+
+
+def em_algorithm_flat(languages,
+                      init_counts,
+                      unambiguous_counts,
+                      convergence_threshold=1e-5,
+                      jobs=1,
+                      callback=None,
+                      accelerate=False,
+                      checkpoint=None,
+                      first_iteration=1):
+    """
+    Same algorithm as em_algorithm but working on FlatLanguage objects, so that each E- and M-step is a handful of
+    vectorized calls per language instead of one Python iteration per word. The phi arrays of the languages are
+    updated in place.
+    :param languages: list of FlatLanguage, one for each language
+    :param init_counts: numpy array with initial (unnormalized) function probabilities
+    :param unambiguous_counts: numpy array with counts of unambiguous words on the form unambiguous_counts[fun]
+    :param convergence_threshold: float
+    :param jobs: number of processes to run the E- and M-steps in, see ParallelSteps
+    :param callback: called with a dict of statistics after each iteration and at the end, see em_log.EMLog
+    :param accelerate: use SQUAREM extrapolation (see squarem_step) after the first two iterations, needs jobs=1
+    :param checkpoint: Checkpoint that the state is saved to every checkpoint.every iterations
+    :param first_iteration: number of the first iteration, larger than 1 when resuming from a checkpoint in which case
+     init_counts and the phi of the languages should be the ones loaded from it
+    :return: the resulting (unnormalized) function probabilities
+    """
+    if accelerate and jobs > 1:
+        raise ValueError('Accelerated EM needs phi in this process and can not be combined with jobs > 1')
     convergence_diff = convergence_threshold
-    total_counts = sum([count for counts in word_counts for count in counts]) + np.sum(unambiguous_counts)
-    expected_counts = dict()
-    expected_fun_counts = dict()
+    total_counts = sum([np.sum(language.counts) for language in languages]) + np.sum(unambiguous_counts)
     probs = init_counts
-    for lang in langs:
-        expected_counts[lang] = [np.zeros([len(poss)]) for poss in word_possibilities[lang]]
+    steps = ParallelSteps(languages, probs.size, jobs) if jobs > 1 else SerialSteps(languages)
 
     # The convergence criterion does not work for first iteration b/c of how we initiate, so make sure we run at least two iterations
-    first = True
-    while convergence_diff >= convergence_threshold:
-        ##  Expectation
-        expected_fun_counts_tot = np.zeros([probs.size]) #\sum_{si} c_{si.}, initialize here, calculate in loop
-        for s in langs:
-            expected_fun_counts[s] = np.zeros([probs.size]) #\sum_i c_{si.}, initialize here, calculate in loop
-            for i in range(len(word_counts[s])):
-                # This is the core of the algorithm where the updating of expected counts are made for each word.
-                # word_possibilities[s][i] contains the function ids off all possible functions for word i in language s
-                # word_probs[s][i] contains the conditional probabilities P(word|function) for word s in language i in
-                # the same order the functions appear in word_possibilities[s][i]
-                # in comments below the the subscript indicies always come in order: language, word, function. Dot
-                # indicates the index the arrays or lists runs over, variable names are same as in thesis
-                joint_probs = word_probs[s][i]*probs[word_possibilities[s][i]] #=P(Y,X) = \phi_{si.}*\pi_.
-                total_prob = np.sum(joint_probs) #P(X) = \sum_k \phi_{sik}*\pi_k
-                if total_prob > 0: #make sure we dont divide by zero, if sum is zero, everything is zero anyway
-                    fun_probs = joint_probs/total_prob #=P(Y|X) = \phi_{si.}*\pi / (\sum_k \phi_{sik}*\pi_k
-                expected_counts[s][i]=word_counts[s][i]*fun_probs #=\hat c_{si.}
-                expected_fun_counts[s][word_possibilities[s][i]]=\
-                    expected_fun_counts[s][word_possibilities[s][i]]+expected_counts[s][i] #\sum_i c_{si.}
-            expected_fun_counts_tot = expected_fun_counts_tot + expected_fun_counts[s] #\sum_{si} c_{si.}
-        ##  Maximization
-        new_probs = unambiguous_counts + expected_fun_counts_tot # this is not the real probs since we don't normalize, but doesnt matter
-                                            # b/c we have normalization constant in numerator denumerator in the
-                                            # expression for fun_probs above
-
-        #new_probs[new_probs < 0.001] = 0
-        for s in langs:
-            for i in range(len(word_counts[s])):
-                with np.errstate(invalid='ignore'):
-                    word_probs[s][i] = np.nan_to_num(expected_counts[s][i]/expected_fun_counts[s][word_possibilities[s][i]])
-
-        ##  Termination criteria
-        if first:
-            first = False
+    first = first_iteration == 1
+    iteration = first_iteration - 1
+    start = time.time()
+    try:
+        while convergence_diff >= convergence_threshold:
+            iteration = iteration + 1
+            # the initial probs and phi are not normalized so the extrapolation only starts from the third iteration
+            if accelerate and iteration > first_iteration + 1:
+                new_probs, expected_fun_counts, e_seconds, m_seconds, accelerated = \
+                    squarem_step(steps, languages, probs, unambiguous_counts)
+            else:
+                new_probs, expected_fun_counts, e_seconds, m_seconds = em_step(steps, probs, unambiguous_counts)
+                accelerated = False
+
+            ##  Termination criteria
+            if first:
+                first = False
+            else:
+                convergence_diff = kl_convergence(probs, new_probs, total_counts)
+            probs = new_probs
+            if callback:
+                callback({'event': 'iteration',
+                          'iteration': iteration,
+                          'convergence_diff': None if iteration == 1 else float(convergence_diff),
+                          'e_step_seconds': e_seconds,
+                          'm_step_seconds': m_seconds,
+                          'accelerated': accelerated,
+                          'languages': [{'language': s,
+                                         'e_step_seconds': steps.language_seconds[s],
+                                         'expected_count': float(np.sum(expected_fun_counts[s]))}
+                                        for s in range(len(languages))]})
+            if checkpoint and iteration % checkpoint.every == 0:
+                steps.collect_phi()
+                checkpoint.save(iteration, probs, languages)
+    finally:
+        steps.close()
+    if callback:
+        callback({'event': 'done',
+                  'iterations': iteration,
+                  'convergence_diff': float(convergence_diff),
+                  'seconds': time.time() - start})
+    return probs #note normalization of probs here, see comment above
+
+
+def em_step(steps, probs, unambiguous_counts):
+    """
+    One plain EM iteration from probs and the current phi of the languages, phi is updated in place. Returns the new
+    probs, the expected function counts by language and the time spent in the E- and M-steps.
+    """
+    e_start = time.time()
+    ##  Expectation
+    expected_fun_counts = steps.expectation(probs) #\sum_i c_{si.} for each language s
+    expected_fun_counts_tot = np.sum(expected_fun_counts, axis=0) #\sum_{si} c_{si.}
+    m_start = time.time()
+    ##  Maximization
+    new_probs = unambiguous_counts + expected_fun_counts_tot # this is not the real probs since we don't normalize, but doesnt matter
+                                        # b/c we have normalization constant in numerator denumerator in the
+                                        # expression for fun_probs above
+    steps.maximization(expected_fun_counts)
+    return new_probs, expected_fun_counts, m_start - e_start, time.time() - m_start
+
+
+def squarem_step(steps, languages, probs, unambiguous_counts):
+    """
+    One SQUAREM update (Varadhan & Roland 2008, scheme S3) of probs and phi. Two plain EM steps give the first and
+    second differences r and v, the parameters are extrapolated to theta - 2*alpha*r + alpha^2*v with
+    alpha = -|r|/|v| (at most -1, which is the same as the two plain steps), clipped at zero and renormalized, and then
+    stabilized with a third EM step. If the likelihood of the extrapolated parameters is lower than that of the
+    starting point the result of the second plain step is used instead. Fixed points are the same as for plain EM.
+    Returns the new probs, the expected function counts by language of the last E-step, the time spent in the E- and
+    M-steps and whether the extrapolation was used.
+    """
+    phi0 = [language.phi for language in languages]
+    probs1, _, e1, m1 = em_step(steps, probs, unambiguous_counts)
+    likelihood0 = log_likelihood(languages, probs, unambiguous_counts)
+    phi1 = [language.phi for language in languages]
+    probs2, expected_fun_counts2, e2, m2 = em_step(steps, probs1, unambiguous_counts)
+    phi2 = [language.phi for language in languages]
+
+    r = [probs1 - probs] + [p1 - p0 for p0, p1 in zip(phi0, phi1)]
+    v = [probs2 - probs1 - r[0]] + [p2 - p1 - rr for p1, p2, rr in zip(phi1, phi2, r[1:])]
+    r_norm = np.sqrt(sum(np.dot(x, x) for x in r))
+    v_norm = np.sqrt(sum(np.dot(x, x) for x in v))
+    if v_norm == 0:
+        return probs2, expected_fun_counts2, e1 + e2, m1 + m2, False
+    alpha = min(-r_norm/v_norm, -1)
+
+    extrapolated_probs = np.maximum(probs - 2*alpha*r[0] + alpha**2*v[0], 0)
+    extrapolated_probs = extrapolated_probs*(np.sum(probs2)/np.sum(extrapolated_probs))
+    for language, p0, rr, vv in zip(languages, phi0, r[1:], v[1:]):
+        phi = np.maximum(p0 - 2*alpha*rr + alpha**2*vv, 0)
+        fun_sums = np.bincount(language.fun_ids, weights=phi, minlength=probs.size)[language.fun_ids]
+        language.phi = np.divide(phi, fun_sums, out=np.zeros_like(phi), where=fun_sums > 0)
+    probs3, expected_fun_counts3, e3, m3 = em_step(steps, extrapolated_probs, unambiguous_counts)
+    if not log_likelihood(languages, extrapolated_probs, unambiguous_counts) >= likelihood0:
+        # the extrapolation went too far, fall back to the plain step
+        for language, phi in zip(languages, phi2):
+            language.phi = phi
+        return probs2, expected_fun_counts2, e1 + e2 + e3, m1 + m2 + m3, False
+    return probs3, expected_fun_counts3, e1 + e2 + e3, m1 + m2 + m3, True
+
+
+def log_likelihood(languages, probs, unambiguous_counts):
+    """
+    Log-likelihood of the data under probs and the phi used in the last E-step of the languages (which must have been
+    run with probs): sum_si c_si*log(sum_k phi_sik*pi_k) + sum_k u_k*log(pi_k), with pi = probs normalized
+    """
+    total = np.sum(probs)
+    likelihood = sum(language.log_likelihood - np.sum(language.counts)*np.log(total) for language in languages)
+    unambiguous = unambiguous_counts > 0
+    return likelihood + np.sum(unambiguous_counts[unambiguous]*np.log(probs[unambiguous]/total))
+
+
+class SerialSteps:
+    """
+    Runs the E- and M-steps for all languages in this process. language_seconds holds the time of the last E-step of
+    each language.
+    """
+    def __init__(self, languages):
+        self.languages = languages
+        self.expected_counts = [None]*len(languages)
+        self.language_seconds = [0.0]*len(languages)
+
+    def expectation(self, probs):
+        """Returns an array with the expected function counts on the form expected_fun_counts[lang][fun]"""
+        expected_fun_counts = np.zeros([len(self.languages), probs.size])
+        for s, language in enumerate(self.languages):
+            start = time.time()
+            self.expected_counts[s], expected_fun_counts[s] = language.expectation(probs)
+            self.language_seconds[s] = time.time() - start
+        return expected_fun_counts
+
+    def maximization(self, expected_fun_counts):
+        for s, language in enumerate(self.languages):
+            language.maximization(self.expected_counts[s], expected_fun_counts[s])
+
+    def collect_phi(self):
+        """phi is always up to date in the languages"""
+        pass
+
+    def close(self):
+        self.expected_counts = [None]*len(self.languages)
+
+
+class ParallelSteps:
+    """
+    Runs the E- and M-steps in a pool of worker processes. Languages are split into shards of whole words, large
+    languages into several, and each worker owns a fixed set of shards for the whole run so the expected counts never
+    leave the worker. probs and the per language expected function counts are passed through shared memory, the
+    only thing sent over the pipes per iteration is one partial count array per language and worker. language_seconds
+    holds the time of the last E-step of each language summed over its shards.
+    """
+    def __init__(self, languages, n_funs, jobs):
+        self.languages = languages
+        self.language_seconds = [0.0]*len(languages)
+        self.n_funs = n_funs
+        self.shards = self.make_shards(languages, jobs)
+        self.probs_shm = shared_memory.SharedMemory(create=True, size=max(1, 8*n_funs))
+        self.counts_shm = shared_memory.SharedMemory(create=True, size=max(1, 8*n_funs*len(languages)))
+        self.probs = np.ndarray([n_funs], dtype=np.float64, buffer=self.probs_shm.buf)
+        self.expected_fun_counts = np.ndarray([len(languages), n_funs], dtype=np.float64, buffer=self.counts_shm.buf)
+
+        # Assign the shards largest first to the worker with the least work so far
+        loads = [0]*jobs
+        self.assignment = [list() for _ in range(jobs)]
+        for shard in sorted(range(len(self.shards)), key=lambda i: -self.shards[i][3].fun_ids.size):
+            worker = loads.index(min(loads))
+            self.assignment[worker].append(shard)
+            loads[worker] = loads[worker] + self.shards[shard][3].fun_ids.size
+
+        self.connections = list()
+        self.workers = list()
+        for shard_ids in self.assignment:
+            if not shard_ids:
+                continue
+            parent, child = multiprocessing.Pipe()
+            worker = multiprocessing.Process(target=_steps_worker,
+                                             args=(child, [self.shards[i] for i in shard_ids],
+                                                   self.probs_shm.name, self.counts_shm.name,
+                                                   n_funs, len(languages)),
+                                             daemon=True)
+            worker.start()
+            child.close()
+            self.connections.append((parent, shard_ids))
+            self.workers.append(worker)
+
+    @staticmethod
+    def make_shards(languages, jobs):
+        """Splits the languages into shards (shard id, language, (first word, last word), FlatLanguage)"""
+        total_size = sum(language.fun_ids.size for language in languages)
+        max_size = max(1, -(-total_size // (2*jobs))) # aim for at least two shards per worker
+        shards = list()
+        for s, language in enumerate(languages):
+            start = 0
+            while start < language.counts.size:
+                end = int(np.searchsorted(language.offsets, language.offsets[start] + max_size, side='right')) - 1
+                end = min(max(end, start + 1), language.counts.size)
+                shards.append((len(shards), s, (start, end), language.slice(start, end)))
+                start = end
+        return shards
+
+    def expectation(self, probs):
+        self.probs[:] = probs
+        for connection, _ in self.connections:
+            connection.send('e')
+        expected_fun_counts = np.zeros([len(self.languages), self.n_funs])
+        self.language_seconds = [0.0]*len(self.languages)
+        for connection, _ in self.connections:
+            for s, counts, seconds in connection.recv():
+                expected_fun_counts[s] = expected_fun_counts[s] + counts
+                self.language_seconds[s] = self.language_seconds[s] + seconds
+        return expected_fun_counts
+
+    def maximization(self, expected_fun_counts):
+        self.expected_fun_counts[:] = expected_fun_counts
+        for connection, _ in self.connections:
+            connection.send('m')
+        for connection, _ in self.connections:
+            connection.recv()
+
+    def collect_phi(self):
+        """Copies phi from the workers into the languages"""
+        phis = dict()
+        for connection, _ in self.connections:
+            connection.send('phi')
+            phis.update(connection.recv())
+        for shard_id, s, (start, end), _ in self.shards:
+            language = self.languages[s]
+            language.phi[language.offsets[start]:language.offsets[end]] = phis[shard_id]
+
+    def close(self):
+        """Collects phi from the workers into the languages, stops the workers and frees the shared memory"""
+        self.collect_phi()
+        for connection, _ in self.connections:
+            connection.send(None)
+        for worker in self.workers:
+            worker.join()
+        del self.probs, self.expected_fun_counts
+        for shm in (self.probs_shm, self.counts_shm):
+            shm.close()
+            shm.unlink()
+
+
+def _steps_worker(connection, shards, probs_name, counts_name, n_funs, n_langs):
+    """Worker loop for ParallelSteps, answers the commands 'e', 'm', 'phi' and None (stop)"""
+    probs_shm = shared_memory.SharedMemory(name=probs_name)
+    counts_shm = shared_memory.SharedMemory(name=counts_name)
+    probs = np.ndarray([n_funs], dtype=np.float64, buffer=probs_shm.buf)
+    language_counts = np.ndarray([n_langs, n_funs], dtype=np.float64, buffer=counts_shm.buf)
+    expected_counts = dict()
+    while True:
+        command = connection.recv()
+        if command == 'e':
+            partial = dict()
+            seconds = dict()
+            for shard_id, s, _, language in shards:
+                start = time.time()
+                expected_counts[shard_id], counts = language.expectation(probs)
+                partial[s] = partial[s] + counts if s in partial else counts
+                seconds[s] = seconds.get(s, 0.0) + time.time() - start
+            connection.send([(s, counts, seconds[s]) for s, counts in partial.items()])
+        elif command == 'm':
+            for shard_id, s, _, language in shards:
+                language.maximization(expected_counts[shard_id], language_counts[s])
+            connection.send(True)
+        elif command == 'phi':
+            connection.send({shard_id: language.phi for shard_id, _, _, language in shards})
+        else:
+            break
+    del probs, language_counts
+    probs_shm.close()
+    counts_shm.close()
+    connection.close()
+
+
+def kl_convergence(probs, new_probs, total_counts):
+    """
+    The convergence criterion, KL divergence of the new probs from the old ones scaled by the total count, the same
+    as in new_em.EM.get_convergence_diff
+    """
+    non_zero = (probs > 1e-20) & (new_probs > 1e-20)
+    return np.sum(new_probs[non_zero]*np.log(new_probs[non_zero]/probs[non_zero]))/total_counts
+
+
+def read_em_data(lines, features=4, poss_columns=2, factored=False):
+    """
+    Reads EM data in the tsv format described in the usage of this script (as written by make_em_data.py), or in the
+    factored format of make_em_data.py --factored if factored is set, where the possibilities are expanded here. The
+    lines are streamed into growable typed buffers: the columns of every possibility are interned to integers and
+    stored flat, together with the counts and CSR offsets of each language. Function ids are given at the end with one
+    np.unique over all possibilities, in the order the functions are first seen, so no Python objects are kept per
+    word or per function while reading.
+    :param lines: iterable over the lines of the data, the first line must be ---
+    :param features: number of feature columns
+    :param poss_columns: number of columns per possibility
+    :param factored: read the factored format
+    :return: list of FlatLanguage with the ambiguous words, unambiguous_counts and id2fun, the function tuple for each
+     function id
+    """
+    lines = iter(lines)
+    if next(lines, '').strip('\n') != '---':
+        raise ValueError('Input must start with ---')
+
+    names = dict() # interned column strings
+    columns = array('q') # ids of the column strings, poss_columns for each possibility, for all languages
+    language_buffers = list()
+
+    # These buffers go over all words in one language, both ambiguous and unambiguous
+    wc = array('q') # counts
+    offsets = array('q', [0]) # where the possibilities of each word start
+    for l in lines:
+        if l.strip('\n') == '---': #new language
+            language_buffers.append((wc, offsets))
+            wc = array('q')
+            offsets = array('q', [0])
         else:
-            non_zero_probs = probs[probs>0]
-            prob_quotients = new_probs[probs>0] / non_zero_probs
-            convergence_diff = np.sum(non_zero_probs[prob_quotients>1e-20]*np.log(prob_quotients[prob_quotients>1e-20]))/total_counts
-        probs = new_probs
-    return probs, word_probs #note normalization of probs here, see comment above
+            l_split = l.strip('\n').split('\t')
+            wc.append(int(l_split[0]))
+            if factored:
+                n_possibilities = _expand_factored(l_split, 1+features, poss_columns, names, columns)
+            else:
+                for name in l_split[1+features:]:
+                    name_id = names.get(name)
+                    if name_id is None:
+                        name_id = names[name] = len(names)
+                    columns.append(name_id)
+                n_possibilities = (len(l_split)-(1+features))//poss_columns
+            offsets.append(offsets[-1] + n_possibilities)
+    language_buffers.append((wc, offsets))
+
+    # give each distinct function an id in the order they are first seen
+    funs = np.frombuffer(columns, dtype=np.int64).reshape([-1, poss_columns])
+    if funs.size:
+        unique_funs, first, inverse = np.unique(funs, axis=0, return_index=True, return_inverse=True)
+        order = np.argsort(first)
+        rank = np.empty_like(order)
+        rank[order] = np.arange(order.size)
+        all_fun_ids = rank[inverse.reshape([-1])]
+        id2name = np.array(list(names.keys()), dtype=object)
+        unique_funs = unique_funs[order]
+        id2fun = list(zip(*[id2name[unique_funs[:, i]] for i in range(poss_columns)]))
+    else:
+        all_fun_ids = np.zeros([0], dtype=np.int64)
+        id2fun = list()
+    del names, columns, funs
+
+    languages = list()
+    unambiguous_counts = np.zeros([len(id2fun)])
+    start = 0
+    for wc, offsets in language_buffers:
+        offsets = np.frombuffer(offsets, dtype=np.int64)
+        language, counts = _split_ambiguous(np.frombuffer(wc, dtype=np.int64), offsets,
+                                            all_fun_ids[start:start+offsets[-1]], len(id2fun))
+        languages.append(language)
+        unambiguous_counts = unambiguous_counts + counts
+        start = start + offsets[-1]
+    return languages, unambiguous_counts, id2fun
+
+
+def _expand_factored(l_split, start, positions, names, columns):
+    """
+    Interns the possibilities of each position of a factored row, given from column start as their number followed by
+    the possibilities, appends all their combinations to columns and returns the number of combinations
+    """
+    position_ids = list()
+    for _ in range(positions):
+        n = int(l_split[start])
+        ids = list()
+        for name in l_split[start+1:start+1+n]:
+            name_id = names.get(name)
+            if name_id is None:
+                name_id = names[name] = len(names)
+            ids.append(name_id)
+        position_ids.append(ids)
+        start = start + 1 + n
+    n_possibilities = 0
+    for fun in product(*position_ids):
+        columns.extend(fun)
+        n_possibilities = n_possibilities + 1
+    return n_possibilities
+
+
+def _split_ambiguous(counts, offsets, fun_ids, n_funs):
+    """
+    Splits the words of one language given CSR-style into a FlatLanguage with the ambiguous words, phi set to ones,
+    and the counts of the unambiguous words (the ones with exactly one possible function) by function id
+    """
+    lengths = np.diff(offsets)
+    unambiguous = lengths == 1
+    unambiguous_counts = np.bincount(fun_ids[offsets[:-1][unambiguous]], weights=counts[unambiguous],
+                                     minlength=n_funs)
+    ambiguous_offsets = np.zeros([np.count_nonzero(~unambiguous) + 1], dtype=np.int64)
+    np.cumsum(lengths[~unambiguous], out=ambiguous_offsets[1:])
+    ambiguous_fun_ids = fun_ids[np.repeat(~unambiguous, lengths)]
+    language = FlatLanguage(counts[~unambiguous], ambiguous_offsets, ambiguous_fun_ids,
+                            np.ones([ambiguous_fun_ids.size]))
+    return language, unambiguous_counts
+
+
+def read_em_binary(prefixes):
+    """
+    Reads EM data in the binary format written by make_em_data.py -b, one prefix (path without the .counts.npy etc.
+    suffixes) per language. The arrays are memory mapped and only the function tables are handled as Python objects,
+    the function ids are given in the order they are first seen, same as for read_em_data.
+    :param prefixes: list of path prefixes, one for each language
+    :return: list of FlatLanguage with the ambiguous words, unambiguous_counts and id2fun
+    """
+    fun2id = dict()
+    id2fun = list()
+    data = list()
+    for prefix in prefixes:
+        with open(prefix + '.funtable.tsv', mode='r', encoding='utf-8') as file:
+            local2global = list()
+            for l in file:
+                fun = tuple(l.strip('\n').split('\t'))
+                if fun not in fun2id:
+                    fun2id[fun] = len(id2fun)
+                    id2fun.append(fun)
+                local2global.append(fun2id[fun])
+        counts = np.load(prefix + '.counts.npy', mmap_mode='r')
+        offsets = np.load(prefix + '.offsets.npy', mmap_mode='r')
+        funs = np.load(prefix + '.funs.npy', mmap_mode='r')
+        data.append((counts, offsets, np.array(local2global, dtype=np.int64)[funs]))
+
+    languages = list()
+    unambiguous_counts = np.zeros([len(id2fun)])
+    for counts, offsets, fun_ids in data:
+        language, counts = _split_ambiguous(counts, offsets, fun_ids, len(id2fun))
+        languages.append(language)
+        unambiguous_counts = unambiguous_counts + counts
+    return languages, unambiguous_counts, id2fun
+
+
+class Checkpoint:
+    """
+    Saves the state of an EM run, that is the iteration, probs, phi of every language and the function table the ids
+    refer to, to one .npz file every `every` iterations. An interrupted run is resumed by loading it into languages
+    read from the same data and passing the loaded iteration + 1 and probs to em_algorithm_flat.
+    """
+    def __init__(self, path, id2fun, every=10):
+        self.path = path
+        self.funs = np.array(['\t'.join(fun) for fun in id2fun], dtype=str)
+        self.every = every
+
+    def save(self, iteration, probs, languages):
+        # write to a temporary file first so that a crash while saving does not destroy the last checkpoint
+        with open(self.path + '.tmp', mode='wb') as file:
+            np.savez(file, iteration=iteration, probs=probs, funs=self.funs,
+                     **{'phi_' + str(s): language.phi for s, language in enumerate(languages)})
+        os.replace(self.path + '.tmp', self.path)
+
+    def load(self, languages):
+        """Sets phi of the languages and returns (iteration, probs), or None if there is no checkpoint"""
+        if not os.path.isfile(self.path):
+            return None
+        with np.load(self.path) as data:
+            phis = [data['phi_' + str(s)] if 'phi_' + str(s) in data else None for s in range(len(languages))]
+            if not np.array_equal(data['funs'], self.funs) or \
+                    len(data.files) - 3 != len(languages) or \
+                    any(phi is None or phi.size != language.fun_ids.size for phi, language in zip(phis, languages)):
+                raise ValueError('Checkpoint %s was not made from the same data' % self.path)
+            for phi, language in zip(phis, languages):
+                language.phi = phi
+            return int(data['iteration']), data['probs']
+
+    def remove(self):
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+
+
+def read_cnt(path, poss_columns=2):
+    """
+    Reads probabilities written by this script or run_em.py (possibly with the deprel of the split as an extra last
+    column) into a dict on the form probs[deprel][fun], deprel is None for rows without it
+    """
+    probs = dict()
+    with open(path, mode='r', encoding='utf-8') as file:
+        for l in file:
+            l_split = l.strip('\n').split('\t')
+            fun = tuple(l_split[1:1+poss_columns])
+            deprel = l_split[1+poss_columns] if len(l_split) > 1+poss_columns else None
+            by_fun = probs.setdefault(deprel, dict())
+            by_fun[fun] = by_fun.get(fun, 0.0) + float(l_split[0])
+    return probs
+
+
+def warm_start_probs(warm_probs, id2fun, floor=0.0001):
+    """
+    Initial probs for em_algorithm from the probs of an earlier run (one of the dicts from read_cnt), functions that
+    are missing from it get floor since EM can never move a function away from zero
+    """
+    return np.array([max(warm_probs.get(fun, 0.0), floor) for fun in id2fun])
+
+
+def format_probs(probs, id2fun, threshold=None, extra=()):
+    """
+    Yields the output lines (without newline) of the script, one per function: probability followed by the function
+    columns and the columns in extra. Functions with a probability not above threshold are left out if it is given.
+    """
+    for fun, probability in zip(id2fun, probs.tolist()):
+        if threshold is None or probability > threshold:
+            yield '\t'.join([str(probability)] + list(fun) + list(extra))
 
 
 if __name__ == '__main__':
@@ -85,87 +645,80 @@ if __name__ == '__main__':
      in latent space, with each possibility consisting of p columns. A syntactic bigram with part of speech tag is
      normaly given in four columns in observed space (one for each lemma, one for each pos tag) and two columns for each
      possibility (one for each function in each possible function-bigram). When processing n-grams ALL possible
-     combinations of possible latent functions should be given. Please use make_em_data.py to generate the data files 
+     combinations of possible latent functions should be given, or with --factored the possible functions of each
+     position once as their number followed by the functions. Please use make_em_data.py to generate the data files
      that feeds this script.
     """)
     parser.add_argument('-f', type=int,
                         help='Number of feature columns.',
                         default=4)
     parser.add_argument('-p', type=int, help='Number of columns per possibility', default=2)
+    parser.add_argument('-j', type=int, help='Number of processes used for the E- and M-steps', default=1)
+    parser.add_argument('-b', nargs='+', metavar='PREFIX',
+                        help='Read the binary format written by make_em_data.py -b from these paths (one per language, '
+                             'without suffix) instead of tsv on stdin')
+    parser.add_argument('--factored', action='store_true',
+                        help='The input is in the factored format of make_em_data.py --factored')
+    parser.add_argument('--log', type=str, help='Append statistics for each iteration as JSON lines to this file')
+    parser.add_argument('--accelerate', action='store_true', help='Use SQUAREM accelerated EM (only with -j 1)')
+    parser.add_argument('--checkpoint', type=str,
+                        help='Save the EM state to this file and resume from it if it exists, it is removed when done')
+    parser.add_argument('--checkpoint-every', type=int, help='Iterations between checkpoints', default=10)
+    parser.add_argument('--warm-start', type=str,
+                        help='Initialize the function probabilities from the output of an earlier run')
+    parser.add_argument('--deprel', type=str,
+                        help='Only use the rows of the warm start file with this deprel in the last column')
     args = parser.parse_args()
+    if args.accelerate and args.j > 1:
+        parser.error('--accelerate can not be combined with -j > 1')
 
     import sys
 
-    if sys.stdin.__next__().strip('\n') != '---':
-        print('Input must start with ---', file=sys.stderr)
-        exit(1)
-
-    # These lists index over all languages
-    word_counts = list()
-    word_possibilities=list()
-    word_probabilities=list()
-
-    # These are used to convert the functions to unique integer ID:s
-    fun2id = dict()
-    id2fun = list()
-    current_id = 0
-
-    # These lists go over all words in one language
-    wc = list() # counts
-    wp = list() # possibilities (dictionary)
-    wprob = list() # conditional word probabilities (phi in the report), P(word|function)
-    unambiguous_counts = list() # goes over all functions, used for unambiguous words to optimize processing in em algorithm
-    for l in sys.stdin:
-        if l.strip('\n') == '---': #new language
-            # append data for this language to the data-by-language lists and reinitialize
-            word_counts.append(wc)
-            word_possibilities.append(wp)
-            word_probabilities.append(wprob)
-            wc = list()
-            wp = list()
-            wprob = list()
-        else:
-            l_split = l.strip('\n').split('\t')
-
-            if len(l_split)==(1+args.f+args.p): # word is unambiguous
-                fun = tuple(l_split[1+args.f:])
-                if fun not in fun2id.keys(): # first time we see this function so give it an id
-                    id2fun.append(fun)
-                    fun2id[fun] = current_id
-                    current_id = current_id + 1
-                    unambiguous_counts.append(int(l_split[0]))
-                else:
-                    unambiguous_counts[fun2id[fun]] = unambiguous_counts[fun2id[fun]] + int(l_split[0])
-            else: # word is ambiguous
-                funs = list()
-                wc.append(int(l_split[0]))
-                for i in range(0, len(l_split)-(1+args.f), args.p): # for each possible function
-                    fun = tuple(l_split[1+args.f+i:1+args.f+i+args.p])
-                    if fun not in fun2id.keys(): # first time we see this function so give it an id
-                        id2fun.append(fun)
-                        fun2id[fun] = current_id
-                        current_id = current_id + 1
-                        unambiguous_counts.append(0)
-                    funs.append(fun2id[fun])
-                wp.append(np.array(funs))
-                wprob.append(np.ones([len(funs)]))
-
-    # append data for the last language to the data-by-language lists and reinitialize delete the mapping from fun to id
-    #  to save memory
-    word_counts.append(wc)
-    word_possibilities.append(wp)
-    word_probabilities.append(wprob)
-    del(fun2id)
-
-    unambiguous_counts = np.array(unambiguous_counts)
-    # initialize starting probabilities for em algorithm uniformly
-    init_probs = np.ones([len(id2fun)])# + np.random.uniform([len(id2fun)])/10
-    em_probs, _ = em_algorithm(word_counts,
-                 init_probs,
-                 unambiguous_counts,
-                 word_probabilities,
-                 word_possibilities,
-                 convergence_threshold=1e-5)
-    for fun, probability in zip(id2fun, np.nditer(em_probs, order='C')):
-        print(*([probability] + list(fun)), sep='\t')
+    if args.b:
+        languages, unambiguous_counts, id2fun = read_em_binary(args.b)
+    else:
+        try:
+            languages, unambiguous_counts, id2fun = read_em_data(sys.stdin, args.f, args.p, args.factored)
+        except ValueError as e:
+            print(e, file=sys.stderr)
+            exit(1)
 
+    if args.warm_start:
+        warm_probs = read_cnt(args.warm_start, args.p)
+        if args.deprel not in warm_probs:
+            deprels = sorted(deprel for deprel in warm_probs if deprel is not None)
+            if args.deprel is None:
+                parser.error('the rows of {} have a deprel in the last column, choose one with --deprel: {}'
+                             .format(args.warm_start, ' '.join(deprels)))
+            if not deprels:
+                parser.error('{} has no deprel column, leave out --deprel'.format(args.warm_start))
+            parser.error('{} has no rows with deprel {}, it has: {}'
+                         .format(args.warm_start, args.deprel, ' '.join(deprels)))
+        if not any(fun in warm_probs[args.deprel] for fun in id2fun):
+            parser.error('none of the functions in {} are in the data, check -p and --deprel'.format(args.warm_start))
+        init_probs = warm_start_probs(warm_probs[args.deprel], id2fun)
+    else:
+        # initialize starting probabilities for em algorithm uniformly
+        init_probs = np.ones([len(id2fun)])# + np.random.uniform([len(id2fun)])/10
+    first_iteration = 1
+    checkpoint = Checkpoint(args.checkpoint, id2fun, args.checkpoint_every) if args.checkpoint else None
+    if checkpoint:
+        state = checkpoint.load(languages)
+        if state:
+            iteration, init_probs = state
+            first_iteration = iteration + 1
+            print('Resuming from iteration', iteration, file=sys.stderr)
+    with EMLog(args.log) as log:
+        em_probs = em_algorithm_flat(languages,
+                     init_probs,
+                     unambiguous_counts,
+                     convergence_threshold=1e-5,
+                     jobs=args.j,
+                     callback=log if args.log else None,
+                     accelerate=args.accelerate,
+                     checkpoint=checkpoint,
+                     first_iteration=first_iteration)
+    if checkpoint:
+        checkpoint.remove()
+    for line in format_probs(em_probs, id2fun):
+        print(line)
@@ -0,0 +1,103 @@
+from multiprocessing import Pool
+import argparse
+import sqlite3
+import sys
+import os
+from database import table_columns, create_table, insert_rows, finish_table
+PYTHONIOENCODING="UTF-8"
+
+
+def connect(path):
+    """Opens a database for bulk loading, without journal or syncing, so a failed load leaves a broken file"""
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA journal_mode=OFF')
+    conn.execute('PRAGMA synchronous=OFF')
+    conn.execute('PRAGMA cache_size=-{}'.format(256 << 10))
+    return conn
+
+
+def table_name(path):
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def read_rows(path):
+    with open(path, mode='r', encoding='utf-8', buffering=1 << 20) as file:
+        for l in file:
+            yield l.rstrip('\n').split('\t')
+
+
+def file_columns(path):
+    """Returns the key columns of the table for the file at path, from its name and the columns of its first line"""
+    with open(path, mode='r', encoding='utf-8') as file:
+        first = file.readline().rstrip('\n')
+    return table_columns(table_name(path), len(first.split('\t')) - 1 if first else None)
+
+
+def load_file(conn, path, schema='main'):
+    """Loads the file at path into a new table of schema in conn, without index, and returns the table's total"""
+    name = table_name(path)
+    cols = file_columns(path)
+    with conn:
+        create_table(conn, name, cols, schema)
+        return insert_rows(conn, name, read_rows(path), cols)
+
+
+def load_part(task):
+    """Loads one file into its own database next to the output, run in a worker, see create_db"""
+    path, part_path = task
+    if os.path.exists(part_path):
+        os.remove(part_path)
+    conn = connect(part_path)
+    total = load_file(conn, path)
+    conn.close()
+    return path, part_path, total
+
+
+def create_db(db_path, paths, jobs=1):
+    """
+    Loads each probability file in paths into a table of the database at db_path named after the file, replacing
+    the table if it exists, and sets its total in total_probs. With more than one job the files are loaded in
+    parallel into separate databases, which are then attached and copied into db_path one at a time.
+    """
+    conn = connect(db_path)
+    if jobs > 1 and len(paths) > 1:
+        tasks = [(path, '{}.{}.part'.format(db_path, i)) for i, path in enumerate(paths)]
+        with Pool(jobs) as pool:
+            for path, part_path, total in pool.imap_unordered(load_part, tasks):
+                name = table_name(path)
+                cols = file_columns(path)
+                print(name, file=sys.stderr)
+                conn.execute('ATTACH DATABASE ? AS part', (part_path,))
+                with conn:
+                    create_table(conn, name, cols)
+                    conn.execute('INSERT INTO main.%s SELECT * FROM part.%s' % (name, name))
+                    finish_table(conn, name, cols, total)
+                conn.execute('DETACH DATABASE part')
+                os.remove(part_path)
+    else:
+        for path in paths:
+            name = table_name(path)
+            cols = file_columns(path)
+            print(name, file=sys.stderr)
+            total = load_file(conn, path)
+            with conn:
+                finish_table(conn, name, cols, total)
+    conn.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="""
+    Loads probability files (prob followed by the key columns, tab separated) into the SQLite database read by
+    evaluation/database.py, one table per file named after it, as create_db.sh does. The key columns are named
+    from the file name as in create_db.sh (child, then head unless the name contains uni or onlydep, then deprel
+    unless it contains nodep or onlydep), or child, head and deprel in order if that does not match the file.
+    It uses evaluation/database.py, run it with evaluation on the PYTHONPATH.
+    """)
+    parser.add_argument('db', type=str, help='Database file, created if it does not exist')
+    parser.add_argument('files', type=str, nargs='+', help='Probability files')
+    parser.add_argument('-j', type=int, help='Number of files loaded in parallel', default=os.cpu_count())
+    args = parser.parse_args()
+    for path in args.files:
+        if not os.path.isfile(path):
+            parser.error('{} does not exist'.format(path))
+    create_db(args.db, args.files, args.j)
@@ -1,4 +1,5 @@
 #!/bin/bash
+# Prints sqlite3 commands to load the probability files, see create_db.py for a faster loader in Python
 FILES=$@
 
 for f in $FILES; do